@@ -0,0 +1 @@
+"""Benchmarks for Music Metadata - EDI, not a part of the package."""
@@ -0,0 +1,190 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the benchmark suite.
+
+Usage: python -m benchmarks.run [--records N ...] [--output results.json]
+                                [--compare baseline.json] [--memory]
+
+Each stage is timed on a synthetic file, throughput is reported in records
+per second. With --memory, each stage is run once more with tracemalloc to
+record peak memory (this is slow, so it is not included in timings)."""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from music_metadata.edi.file import EdiFile
+from music_metadata.edi.writer import EdiWriter
+
+from .synthetic import SynFile, synthesize
+
+
+def stage_open(path):
+    with open(path, 'rb') as f:
+        EdiFile(f).close()
+
+
+def stage_groups(path):
+    with open(path, 'rb') as f:
+        e = EdiFile(f)
+        for group in e.get_groups():
+            pass
+        e.close()
+
+
+def stage_transactions(path):
+    with open(path, 'rb') as f:
+        e = EdiFile(f)
+        for group in e.get_groups():
+            for transaction in group.get_transactions():
+                pass
+        e.close()
+
+
+def stage_to_dict(path):
+    with open(path, 'rb') as f:
+        e = EdiFile(f)
+        for group in e.get_groups():
+            for transaction in group.get_transactions():
+                for record in transaction.records:
+                    record.to_dict()
+        e.close()
+
+
+def stage_to_html(path):
+    with open(path, 'rb') as f:
+        e = EdiFile(f)
+        for chunk in e.iter_html():
+            pass
+        e.close()
+
+
+def stage_to_edi(path):
+    output = io.BytesIO()
+    with open(path, 'rb') as f:
+        e = EdiFile(f)
+        writer = EdiWriter(output, e.header_line)
+        for group in e.get_groups():
+            writer.write_group(
+                group.type, group.get_transactions(), group.header())
+        writer.close()
+        e.close()
+    with open(path, 'rb') as f:
+        if f.read() != output.getvalue():
+            raise RuntimeError('Round trip failed.')
+
+
+STAGES = (
+    ('open', stage_open),
+    ('get_groups', stage_groups),
+    ('get_transactions', stage_transactions),
+    ('to_dict', stage_to_dict),
+    ('to_html', stage_to_html),
+    ('to_edi', stage_to_edi),
+)
+
+
+def run_stage(function, path, repeat=1, memory=False):
+    """Return the best time of repeated runs, and peak memory if asked."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(sizes, field_error_rate=0.0, record_error_rate=0.0, repeat=1,
+        memory=False, stages=None):
+    """Run benchmarks for all sizes, return the results dictionary."""
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            path = os.path.join(folder, f'synthetic_{size}.edi')
+            with open(path, 'wb') as f:
+                records = synthesize(
+                    f, size, field_error_rate, record_error_rate)
+            for name, function in STAGES:
+                if stages and name not in stages:
+                    continue
+                seconds, peak = run_stage(function, path, repeat, memory)
+                results.append({
+                    'stage': name,
+                    'records': records,
+                    'bytes': os.path.getsize(path),
+                    'seconds': round(seconds, 6),
+                    'records_per_second': round(records / seconds),
+                    'peak_memory': peak,
+                })
+                print(f'{name:>16} {records:>10} records '
+                      f'{seconds:10.3f} s {records / seconds:12.0f} rec/s',
+                      file=sys.stderr)
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'file_class': SynFile.__name__,
+        'field_error_rate': field_error_rate,
+        'record_error_rate': record_error_rate,
+        'results': results,
+    }
+
+
+def compare(results, baseline):
+    """Print throughput relative to the baseline results."""
+    base = dict(
+        ((r['stage'], r['records']), r) for r in baseline['results'])
+    for r in results['results']:
+        b = base.get((r['stage'], r['records']))
+        if b is None:
+            continue
+        ratio = r['records_per_second'] / b['records_per_second']
+        print(f'{r["stage"]:>16} {r["records"]:>10} records '
+              f'{ratio:8.2%} of baseline throughput')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run EDI benchmarks.')
+    parser.add_argument(
+        '--records', type=int, nargs='+', default=[10000, 100000],
+        help='file sizes in records, e.g. 10000 1000000 10000000')
+    parser.add_argument('--field-error-rate', type=float, default=0.0)
+    parser.add_argument('--record-error-rate', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--stages', nargs='+',
+                        choices=[name for name, function in STAGES])
+    parser.add_argument('--memory', action='store_true')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='compare with JSON results')
+    args = parser.parse_args(argv)
+    results = run(args.records, args.field_error_rate,
+                  args.record_error_rate, args.repeat, args.memory,
+                  args.stages)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the synthetic file format and generator for benchmarks.
+
+Usage: python -m benchmarks.synthetic OUTPUT [--records N]"""
+
+import argparse
+import random
+
+from music_metadata.edi.fields import *
+from music_metadata.edi.file import EdiFile, EdiGroup
+from music_metadata.edi.records import EdiTransactionRecord
+from music_metadata.edi.transactions import EdiTransaction
+from music_metadata.edi.writer import EdiWriter
+
+ROLES = (('CA', 'Composer/Author'), ('C', 'Composer'), ('A', 'Author'),
+         ('E', 'Publisher'))
+
+
+class SynWRK(EdiTransactionRecord):
+    """Work record, transaction header."""
+    title = EdiField(size=60, mandatory=True)
+    work_id = EdiField(size=14, mandatory=True)
+    duration = EdiNumericField(size=6)
+    recorded = EdiFlagField()
+    language = EdiField(size=2)
+
+
+class SynSHR(EdiTransactionRecord):
+    """Share record, interested party with shares."""
+    chain = EdiNumericField(size=2, mandatory=True)
+    party_id = EdiField(size=9, mandatory=True)
+    name = EdiField(size=45, mandatory=True)
+    role = EdiListField(size=2, choices=ROLES, mandatory=True)
+    society = EdiNumericField(size=3)
+    pr_share = EdiNumericField(size=5)
+    mr_share = EdiNumericField(size=5)
+    sr_share = EdiNumericField(size=5)
+    controlled = EdiBooleanField()
+
+
+class SynTransaction(EdiTransaction):
+    record_type = 'WRK'
+    record_classes = {'WRK': SynWRK, 'SHR': SynSHR}
+
+
+class SynGroup(EdiGroup):
+    transaction_classes = [SynTransaction]
+
+
+class SynFile(EdiFile):
+    """Synthetic EDI file, sender type SY."""
+    group_class = SynGroup
+
+    @classmethod
+    def is_my_header(cls, hdr):
+        return hdr[0:5] == 'HDRSY'
+
+
+HEADER = 'HDRSY000000001SYNTHETIC BENCHMARK PUBLISHER'
+
+
+def synthesize(fileobj, records=10000, field_error_rate=0.0,
+               record_error_rate=0.0, records_per_group=100000, seed=0):
+    """Write a valid synthetic file with (approximately) the given number
+    of records to a binary file object.
+
+    Field errors are invalid list values (FieldError), record errors are
+    non-numeric values in numeric fields (RecordError). Returns the number
+    of records written, including headers and trailers."""
+    rnd = random.Random(seed)
+    writer = EdiWriter(fileobj, HEADER)
+    written = 2
+    group_records = 0
+    t = 0
+    while written < records:
+        if (writer.current_group is None or
+                group_records >= records_per_group):
+            writer.start_group('WRK')
+            written += 2
+            group_records = 0
+        lines = []
+        title = f'SYNTHETIC WORK {t:08d}'
+        lines.append(
+            f'WRK{0:08d}{0:08d}{title:<60}{"W" + str(t):<14}'
+            f'{rnd.randrange(1000):06d}{rnd.choice("YN ")}EN')
+        for i in range(rnd.randrange(2, 8)):
+            role = rnd.choice(ROLES)[0]
+            if rnd.random() < field_error_rate:
+                role = 'XX'
+            share = f'{rnd.randrange(10000):05d}'
+            if rnd.random() < record_error_rate:
+                share = '5O.00'
+            lines.append(
+                f'SHR{0:08d}{0:08d}{i:02d}{rnd.randrange(10 ** 9):09d}'
+                f'{"PARTY " + str(rnd.randrange(10 ** 6)):<45}{role:<2}'
+                f'{rnd.randrange(300):03d}{share}{share}{share}'
+                f'{rnd.choice("YN")}')
+        # sequence numbers are set here, as lines are not records
+        lines = [
+            line[0:3] + f'{writer.current_group["transaction_count"]:08d}'
+            f'{i:08d}' + line[19:]
+            for i, line in enumerate(lines)]
+        writer.write_transaction(lines)
+        written += len(lines)
+        group_records += len(lines)
+        t += 1
+    writer.close()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic file.')
+    parser.add_argument('output')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--field-error-rate', type=float, default=0.0)
+    parser.add_argument('--record-error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    with open(args.output, 'wb') as f:
+        synthesize(f, args.records, args.field_error_rate,
+                   args.record_error_rate, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
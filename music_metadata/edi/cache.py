@@ -0,0 +1,160 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the content-addressed cache of parsed transactions."""
+
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+from .errors import FileError
+from .reader import DECODING_ERRORS
+from .records import EdiTransactionRecord
+
+# Transaction sequence number, masked in cache keys
+SEQUENCE_START = 3
+SEQUENCE_END = 11
+
+
+class EdiTransactionCache(object):
+    """LRU cache of parsed transactions, keyed by a hash of the transaction
+    class and its lines, with transaction sequence numbers masked, so a
+    transaction resent in another file (or position) is found.
+
+    Transactions are stored pickled, in memory, and, if path (a folder) is
+    set, also on disk, one file per transaction. The disk tier must be
+    cleared when definitions of transactions or records change.
+
+    On a hit, the transaction sequence number is decoded again and
+    sequences are validated, as in validate_record. Transactions with
+    file-level errors are not cached, as these depend on the position in
+    the file. Lazy transactions are not cached, but can be served from the
+    cache."""
+
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def get_key(transaction_class, gtype, lines, encoding=None):
+        """Return the key (hex digest) for transaction lines, text or bytes
+        (byte-level parsing, in the encoding) are cached separately."""
+        h = hashlib.blake2b(digest_size=20)
+        if lines and isinstance(lines[0], bytes):
+            mode = f'bytes:{ encoding or "latin1" }'
+        else:
+            mode = 'text'
+        h.update(f'{ transaction_class.__module__ }.'
+                 f'{ transaction_class.__qualname__ }\n{ gtype }\n'
+                 f'{ mode }\n'.encode())
+        for line in lines:
+            if isinstance(line, str):
+                line = line.encode('utf8', 'surrogateescape')
+            h.update(line[:SEQUENCE_START])
+            h.update(line[SEQUENCE_END:])
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def load(self, key):
+        """Return the pickled transaction, None if not in the cache."""
+        try:
+            data = self._data[key]
+        except KeyError:
+            pass
+        else:
+            self._data.move_to_end(key)
+            return data
+        if not self.path:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._set(key, data)
+        return data
+
+    def _set(self, key, data):
+        self._data[key] = data
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def store(self, key, transaction):
+        """Add the transaction to the cache, unless it has file-level
+        errors or can not be pickled."""
+        for record in transaction.records:
+            for error in record.get_errors().values():
+                if isinstance(error, FileError):
+                    return
+        try:
+            data = pickle.dumps(transaction, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return
+        self._set(key, data)
+        if self.path:
+            path = self.get_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+
+    def build_transaction(self, transaction_class, gtype, lines, sequence,
+                          lazy=False, **kwargs):
+        """Return the transaction from the cache, or create (and cache)
+        it. Other keyword arguments are passed to the transaction class."""
+        encoding = kwargs.get('encoding')
+        key = self.get_key(transaction_class, gtype, lines, encoding)
+        data = self.load(key)
+        if data is None:
+            self.misses += 1
+            if lazy:
+                return transaction_class(
+                    gtype, lines, sequence, lazy=True, **kwargs)
+            transaction = transaction_class(gtype, lines, sequence, **kwargs)
+            self.store(key, transaction)
+            return transaction
+        self.hits += 1
+        transaction = pickle.loads(data)
+        self.resequence(transaction, lines, sequence, encoding)
+        return transaction
+
+    @staticmethod
+    def resequence(transaction, lines, sequence, encoding=None):
+        """Apply the transaction sequence from lines to the cached
+        transaction, and validate sequences again.
+
+        In byte-level parsing, lines of records with multibyte characters
+        are decoded (see EdiRecord), so are the lines they are updated
+        from."""
+        transaction.sequence = sequence
+        transaction.lines = lines
+        for r_sequence, (record, line) in enumerate(
+                zip(transaction.records, lines)):
+            if isinstance(line, bytes) and isinstance(record.line, str):
+                line = line.decode(encoding or 'latin1', DECODING_ERRORS)
+            record.line = (
+                record.line[:SEQUENCE_START] +
+                line[SEQUENCE_START:SEQUENCE_END] +
+                record.line[SEQUENCE_END:])
+            if not isinstance(record, EdiTransactionRecord):
+                continue
+            record._decode(
+                record._index['transaction_sequence_number'], record.line,
+                len(line))
+            transaction.validate_record(record, r_sequence)
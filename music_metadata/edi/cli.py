@@ -0,0 +1,151 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the command-line batch validation.
+
+Usage: music-metadata-edi PATH [PATH ...] [--workers N] [--output FILE]
+                          [--recursive] [--file-class MODULE.CLASS]
+
+Paths are files, folders or glob patterns. Files are parsed concurrently,
+each in one of the worker processes, which are reused for all files. One
+JSON report is written, with validity, file errors, counts and timing per
+file, and totals."""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_FILE_CLASS = 'music_metadata.edi.file.EdiFile'
+
+
+def import_class(dotted_path):
+    """Return the class for module.Class."""
+    module_name, class_name = dotted_path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def find_files(paths, recursive=False):
+    """Return sorted file paths from files, folders and glob patterns."""
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                pattern = os.path.join(path, '**', '*')
+            else:
+                pattern = os.path.join(path, '*')
+            found.update(glob.glob(pattern, recursive=recursive))
+        elif os.path.exists(path):
+            found.add(path)
+        else:
+            found.update(glob.glob(path, recursive=recursive))
+    return sorted(p for p in found if os.path.isfile(p))
+
+
+def process_file(path, file_class=DEFAULT_FILE_CLASS):
+    """Parse the file, return its report as a dictionary.
+
+    Exceptions are reported, so one broken file does not stop the batch."""
+    start = time.perf_counter()
+    report = {'path': path}
+    try:
+        with open(path, 'rb') as f:
+            e = import_class(file_class)(f)
+            invalid_groups = 0
+            invalid_transactions = 0
+            for group in e.get_groups():
+                for transaction in group.get_transactions():
+                    if not transaction.valid:
+                        invalid_transactions += 1
+                if not group.valid:
+                    invalid_groups += 1
+            report.update({
+                'file_class': type(e).__name__,
+                'valid': e.valid,
+                'file_errors': [str(err) for err in e.file_errors],
+                'group_count': e.group_sequence,
+                'transaction_count': e.transaction_count,
+                'record_count': e.record_count,
+                'invalid_groups': invalid_groups,
+                'invalid_transactions': invalid_transactions,
+            })
+    except Exception as err:
+        report.update({
+            'valid': False,
+            'file_errors': [f'{type(err).__name__}: {err}'],
+        })
+    report['seconds'] = round(time.perf_counter() - start, 6)
+    return report
+
+
+def process_files(paths, workers=None, file_class=DEFAULT_FILE_CLASS):
+    """Return reports for all files, in the same order.
+
+    Files are parsed in a process pool with that many workers (all CPUs
+    if None), or in this process if workers is 0."""
+    file_classes = [file_class] * len(paths)
+    if workers == 0:
+        return list(map(process_file, paths, file_classes))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(process_file, paths, file_classes))
+
+
+def summarize(reports, seconds):
+    """Return totals for the file reports."""
+    summary = {
+        'files': len(reports),
+        'valid': sum(1 for r in reports if r['valid']),
+        'invalid': sum(1 for r in reports if not r['valid']),
+        'seconds': round(seconds, 6),
+    }
+    for key in ('group_count', 'transaction_count', 'record_count',
+                'invalid_groups', 'invalid_transactions'):
+        summary[key] = sum(r.get(key, 0) for r in reports)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Validate EDI files, write one JSON report.')
+    parser.add_argument('paths', nargs='+',
+                        help='files, folders or glob patterns')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes, all CPUs by default, '
+                             '0 for none')
+    parser.add_argument('--recursive', action='store_true',
+                        help='include files in subfolders')
+    parser.add_argument('--file-class', default=DEFAULT_FILE_CLASS,
+                        help='EdiFile (sub)class, the most specific class '
+                             'is chosen from the header, e.g. for CWR')
+    parser.add_argument('--output', help='report file, stdout by default')
+    args = parser.parse_args(argv)
+    if args.workers is not None and args.workers < 0:
+        parser.error('--workers must not be negative')
+    try:
+        import_class(args.file_class)
+    except (ImportError, AttributeError, ValueError) as err:
+        parser.error(f'--file-class: {err}')
+    paths = find_files(args.paths, args.recursive)
+    start = time.perf_counter()
+    reports = process_files(paths, args.workers, args.file_class)
+    report = {
+        'summary': summarize(reports, time.perf_counter() - start),
+        'files': reports,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
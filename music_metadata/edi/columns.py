@@ -0,0 +1,232 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the columnar export.
+
+NumPy is optional, it is required for EdiColumns.to_numpy, and used for
+batch decoding of numeric columns in EdiColumns.extend_lines."""
+
+from array import array
+from collections import OrderedDict
+
+from .fields import EdiField, EdiNumericField
+from .reader import DECODING_ERRORS
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Value of numeric columns for missing or non-numeric values
+MISSING = -1
+
+# Numeric fields up to this size fit into 64-bit integers
+MAX_BATCH_SIZE = 18
+
+
+def decode_numeric_column(lines, start, end):
+    """Decode a fixed-width numeric column for all lines at once.
+
+    Returns values and the validity mask, values are only set where they
+    consist of digits only, and the mask is False for all other rows,
+    including too short lines. Uses NumPy if available."""
+    if numpy is None:
+        values = array('q')
+        mask = array('b')
+        for line in lines:
+            value = line[start:end]
+            if (len(value) == end - start and value.isascii() and
+                    value.isdigit()):
+                values.append(int(value))
+                mask.append(True)
+            else:
+                values.append(MISSING)
+                mask.append(False)
+        return values, mask
+    size = end - start
+    data = numpy.frombuffer(
+        ''.join(line[start:end].ljust(size) for line in lines).encode(
+            'latin1', 'replace'), dtype=numpy.uint8).reshape(-1, size)
+    digits = data.astype(numpy.int64) - 48
+    mask = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    powers = 10 ** numpy.arange(size - 1, -1, -1, dtype=numpy.int64)
+    values = numpy.where(mask, digits @ powers, MISSING)
+    return values, mask
+
+
+def convert(field, value):
+    """Convert the value with the decode cache of the field, if any, see
+    EdiField.decode."""
+    cache = field._decode_cache
+    if cache is None:
+        return field.convert(value)
+    try:
+        return cache[value]
+    except KeyError:
+        result = field.convert(value)
+        if len(cache) < field.decode_cache_size:
+            cache[value] = result
+        return result
+
+
+class EdiColumns(object):
+    """Column buffers for all records of one record type.
+
+    Columns are built from the field layout of the record class. Numeric
+    fields are kept in integer arrays, with MISSING for empty or invalid
+    values, other fields in lists. Validity of records is kept in the valid
+    column, and errors as (row, label, error) tuples in errors."""
+
+    def __init__(self, record_class):
+        self.record_class = record_class
+        self.fields = record_class._fields
+        self.numeric = OrderedDict(
+            (label, isinstance(field, EdiNumericField))
+            for label, field in self.fields.items())
+        self.columns = OrderedDict(
+            (label, array('q') if numeric else [])
+            for label, numeric in self.numeric.items())
+        self.valid = array('b')
+        self.errors = []
+        # batch decoding requires fields without their own __set__
+        self.batch = all(
+            type(field).__set__ is EdiField.__set__ and
+            not (self.numeric[label] and field._size > MAX_BATCH_SIZE)
+            for label, field in self.fields.items())
+
+    def __len__(self):
+        return len(self.valid)
+
+    def append(self, record):
+        """Add values of a record to columns."""
+        if record._lazy:
+            record.decode_fields()
+        # alphanumeric fields of records from bytes may not be decoded yet
+        if type(record) is self.record_class and record._encoding is None:
+            values = zip(self.columns.items(), record._values)
+        else:
+            values = (
+                ((label, column), getattr(record, label, None))
+                for label, column in self.columns.items())
+        for (label, column), value in values:
+            if self.numeric[label] and not isinstance(value, int):
+                value = MISSING
+            column.append(value)
+        errors = record.get_errors()
+        if errors:
+            row = len(self.valid)
+            self.errors.extend(
+                (row, label, error) for label, error in errors.items())
+        self.valid.append(record.valid)
+
+    def extend_lines(self, lines, encoding='latin1'):
+        """Decode lines of this record type directly into columns.
+
+        Numeric columns are decoded for all lines at once (see
+        decode_numeric_column), other fields are converted per value.
+        Lines with any error or warning, or too short, are decoded by
+        creating the record, so values, validity and errors are the same as
+        with records created from lines. Sequences are not validated.
+
+        Lines can also be bytes (byte-level parsing), these are decoded
+        with the encoding first, as field positions are in characters."""
+        if lines and isinstance(lines[0], bytes):
+            lines = [line.decode(encoding, DECODING_ERRORS) for line in lines]
+        record_class = self.record_class
+        if not self.batch:
+            for line in lines:
+                self.append(record_class(line))
+            return
+        length = record_class._length
+        # (values, mask) of numeric columns, None for other fields
+        plan = []
+        for label, field, start, end, mandatory, decode in (
+                record_class._layout):
+            if self.numeric[label]:
+                values, mask = decode_numeric_column(lines, start, end)
+                plan.append((field, start, end, values.tolist(),
+                             mask.tolist()))
+            else:
+                plan.append((field, start, end, None, None))
+        columns = list(self.columns.values())
+        for i, line in enumerate(lines):
+            if len(line) < length:
+                self.append(record_class(line))
+                continue
+            row = []
+            for field, start, end, values, mask in plan:
+                if values is not None:
+                    if not mask[i]:
+                        break
+                    row.append(values[i])
+                else:
+                    value, error = convert(field, line[start:end])
+                    if error is not None:
+                        break
+                    row.append(value)
+            else:
+                for column, value in zip(columns, row):
+                    column.append(value)
+                self.valid.append(True)
+                continue
+            self.append(record_class(line))
+
+    def to_numpy(self):
+        """Return columns as a NumPy structured array."""
+        if numpy is None:
+            raise ImportError('NumPy is required for this export.')
+        dtype = []
+        for label, field in self.fields.items():
+            if self.numeric[label]:
+                dtype.append((label, 'i8'))
+            elif all(isinstance(v, str) or v is None
+                     for v in self.columns[label]):
+                dtype.append((label, f'U{ field._size }'))
+            else:
+                dtype.append((label, 'O'))
+        dtype.append(('valid', '?'))
+        result = numpy.empty(len(self), dtype=dtype)
+        for label, column in self.columns.items():
+            if self.numeric[label]:
+                result[label] = numpy.frombuffer(column, dtype='i8')
+            elif result.dtype[label].kind == 'U':
+                result[label] = [v or '' for v in column]
+            else:
+                result[label] = column
+        result['valid'] = numpy.frombuffer(self.valid, dtype='i1')
+        return result
+
+
+def lines_to_columns(lines, get_record_class, encoding='latin1'):
+    """Decode lines into columns, grouped by record type, return a
+    dictionary of EdiColumns objects keyed by record type.
+
+    get_record_class is called with the record type, e.g. the method of a
+    transaction. Lines can also be bytes, see EdiColumns.extend_lines."""
+    by_type = OrderedDict()
+    for line in lines:
+        record_type = line[0:3]
+        if isinstance(record_type, bytes):
+            record_type = record_type.decode('latin1')
+        by_type.setdefault(record_type, []).append(line)
+    result = OrderedDict()
+    for record_type, type_lines in by_type.items():
+        columns = result[record_type] = EdiColumns(
+            get_record_class(record_type))
+        columns.extend_lines(type_lines, encoding)
+    return result
+
+
+def to_columns(records):
+    """Export records to columns, return a dictionary of EdiColumns objects
+    keyed by record type."""
+    result = OrderedDict()
+    for record in records:
+        try:
+            columns = result[record.type]
+        except KeyError:
+            columns = result[record.type] = EdiColumns(type(record))
+        columns.append(record)
+    return result
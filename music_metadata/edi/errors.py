@@ -29,3 +29,31 @@ class RecordError(ValueError):
 class TransactionError(ValueError):
     """Makes the transaction invalid."""
     pass
+
+
+class ErrorList(list):
+    """List of errors with a maximum length (maxlen).
+
+    Errors over the limit are not kept, but counted in overflow, and
+    passed to sink (a callable), if set, with context, e.g. to write them
+    to a log. With maxlen 0, all errors go to the sink."""
+
+    def __init__(self, errors=(), maxlen=None, sink=None, context=None):
+        super().__init__()
+        self.maxlen = maxlen
+        self.sink = sink
+        self.context = context
+        self.overflow = 0
+        self.extend(errors)
+
+    def append(self, error):
+        if self.maxlen is not None and len(self) >= self.maxlen:
+            self.overflow += 1
+            if self.sink is not None:
+                self.sink(error, self.context)
+            return
+        super().append(error)
+
+    def extend(self, errors):
+        for error in errors:
+            self.append(error)
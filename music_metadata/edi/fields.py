@@ -11,16 +11,93 @@ from collections import OrderedDict
 from .errors import *
 
 
+class NotDecoded(object):
+    """Marks values of fields not decoded yet, in lazy records and in
+    byte-level parsing. It is a singleton, also when unpickled, e.g. in
+    records from workers or the transaction cache."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'NOT_DECODED'
+
+    def __reduce__(self):
+        return 'NOT_DECODED'
+
+
+NOT_DECODED = NotDecoded()
+
+# Compact error codes, returned by EdiField.decode instead of raising, and
+# turned into exception objects with EdiField.get_error only when needed
+ERROR_MANDATORY = 1
+ERROR_NOT_NUMERIC = 2
+ERROR_OUT_OF_RANGE = 3
+ERROR_NOT_CONSTANT = 4
+ERROR_NOT_IN_LIST = 5
+ERROR_TRUNCATED = 6
+ERROR_MANDATORY_MISSING = 7
+ERROR_MISSING_AT_END = 8
+
+# Codes that do not invalidate the record
+WARNING_CODES = frozenset(
+    (ERROR_NOT_CONSTANT, ERROR_TRUNCATED, ERROR_MISSING_AT_END))
+
+
+def html_template(classes, label):
+    """Return the static parts of the HTML representation of a field, for
+    valid and invalid values."""
+    descriptive_label = label.replace('_', ' ')
+    return (
+        f'<span class="field {classes} {label}" title ="'
+        f'{descriptive_label}: ',
+        f'<span class="field {classes} {label} invalid" '
+        f'title ="{descriptive_label}: ')
+
+
+def render_html(template, edi_value, verbose_value, error=None):
+    """Fill the template from html_template with escaped values."""
+    edi_value = html.escape(str(edi_value))
+    verbose_value = html.escape(str(verbose_value))
+    if error:
+        error = html.escape(str(error))
+        return (f'{template[1]}{verbose_value}\n'
+                f'ERROR: {error}">{edi_value}</span>')
+    return f'{template[0]}{verbose_value}">{edi_value}</span>'
+
+
+REST_HTML_TEMPLATE = html_template('nonetype object', '')
+
+
 class EdiField(object):
     """Base class for all EDI Fields, also used for alphanumeric fields.
 
-    Alphanumeric fields are left-aligned, space-padded and default is blank."""
+    Alphanumeric fields are left-aligned, space-padded and default is blank.
+
+    Results of decoding (value and error code) are memoized per raw value,
+    so repeated values skip conversion and share one object. This is done
+    by default for short fields, as these have a small set of values, and
+    can be set with cache. The number of cached values is limited to
+    decode_cache_size.
+
+    Fields with ascii_only set can be decoded from bytes (in byte-level
+    parsing), without knowing the character set of the file."""
 
     verbose_type = 'Alphanumeric field'
+    decode_cache_size = 1024
+    max_cached_size = 4
+    ascii_only = False
 
-    def __init__(self, size, mandatory=False, *args, **kwargs):
+    def __init__(self, size, mandatory=False, *args, cache=None, **kwargs):
         self._size = size
         self._mandatory = mandatory
+        self._html_templates = {}
+        if cache is None:
+            cache = self.is_cacheable()
+        self._decode_cache = {} if cache else None
+
+    def is_cacheable(self):
+        """Return if decoding should be memoized by default."""
+        return self._size <= self.max_cached_size
 
     def __set_name__(self, owner, name):
         self._name = name
@@ -28,17 +105,66 @@ class EdiField(object):
 
     def __get__(self, instance, owner=None):
         if instance:
-            return instance.__dict__.get(self._name)
+            value = instance._values[instance._index[self._name]]
+            if value is NOT_DECODED:
+                return instance.decode_field(self._name)
+            return value
         return self
 
+    def _store(self, instance, value):
+        """Store the value in the compact storage of the record."""
+        instance._values[instance._index[self._name]] = value
+
     def __set__(self, instance, value):
+        error = self.decode(instance, value)
+        if error is not None:
+            raise self.get_error(*error)
+
+    def decode(self, instance, value):
+        """Store the value, return None if valid, otherwise a tuple with the
+        error code and the offending value. Nothing is raised."""
+        cache = self._decode_cache
+        if cache is None:
+            value, error = self.convert(value)
+        else:
+            try:
+                value, error = cache[value]
+            except KeyError:
+                result = self.convert(value)
+                if len(cache) < self.decode_cache_size:
+                    cache[value] = result
+                value, error = result
+            except TypeError:  # not hashable
+                value, error = self.convert(value)
+        if error is not None and error[0] == ERROR_MANDATORY:
+            return error
+        self._store(instance, value)
+        return error
+
+    def convert(self, value):
+        """Return the value to be stored and None, or the error tuple
+        (see decode). It must not depend on anything but the value."""
+        if isinstance(value, bytes):
+            value = value.decode('latin1')
         if isinstance(value, str):
             value = value.strip()
             if value == '':
                 value = None
         if value is None and self._mandatory:
-            raise FieldError('Value is mandatory')
-        instance.__dict__[self._name] = value
+            return None, (ERROR_MANDATORY, None)
+        return value, None
+
+    def get_error(self, code, value=None):
+        """Return the exception object for an error code."""
+        if code == ERROR_MANDATORY:
+            return FieldError('Value is mandatory')
+        if code == ERROR_TRUNCATED:
+            return FieldWarning('Field truncated')
+        if code == ERROR_MANDATORY_MISSING:
+            return RecordError('Mandatory field missing')
+        if code == ERROR_MISSING_AT_END:
+            return FieldWarning('Field missing at the end of the line.')
+        raise ValueError(f'Unknown error code { code }')
 
     def to_edi(self, value):
         """Return EDI format."""
@@ -50,6 +176,17 @@ class EdiField(object):
         """Return verbose (human-readable) value"""
         return value
 
+    def get_html_template(self, label):
+        """Return the static parts of the HTML representation."""
+        try:
+            return self._html_templates[label]
+        except KeyError:
+            classes = self.__class__.__name__ + ' '
+            classes += ' '.join(c.__name__ for c in self.__class__.__bases__)
+            template = html_template(classes.lower(), label)
+            self._html_templates[label] = template
+            return template
+
     def to_html(self, value, label=None, error=None):
         """Create HTML representation for EDI, used in syntax highlighting"""
         if label is None:
@@ -57,29 +194,19 @@ class EdiField(object):
         if self:
             edi_value = self.to_edi(value)
             verbose_value = self.verbose(value)
+            template = self.get_html_template(label)
         else:
             edi_value = value
             verbose_value = value
-        descriptive_label = label.replace('_', ' ')
-        classes = self.__class__.__name__ + ' '
-        classes += ' '.join(c.__name__ for c in self.__class__.__bases__)
-        classes = classes.lower()
-        if error:
-            error = html.escape(str(error))
-            return (f'<span class="field {classes} {label} invalid" '
-                    f'title ="{descriptive_label}: {verbose_value}\n'
-                    f'ERROR: {error}">{edi_value}</span>')
-        else:
-            return (f'<span class="field {classes} {label}" title ="'
-                    f'{descriptive_label}:'
-                    f' {verbose_value}">{edi_value}</span>')
+            template = html_template('nonetype object', label)
+        return render_html(template, edi_value, verbose_value, error)
 
     def to_dict(self, record, label=None, verbosity=1):
         """Create the dictionary with the value and additional data."""
         if label is None:
             label = self._name
         value = getattr(record, label or self._name)
-        valid = record.valid or label not in record.errors
+        valid = record.valid or label not in record.get_errors()
         if value is None and valid and verbosity <= 1:
             return None
         if value is not None and valid and verbosity == 0:
@@ -90,7 +217,7 @@ class EdiField(object):
             d['field_mandatory'] = self._mandatory
         d['valid'] = valid
         if not valid or verbosity > 1:
-            error = record.errors.get(label)
+            error = record.get_errors().get(label)
             if error:
                 d['error'] = str(error)
             else:
@@ -104,19 +231,31 @@ class EdiNumericField(EdiField):
     with zeros."""
 
     verbose_type = 'Numeric field'
+    ascii_only = True
 
-    def __set__(self, instance, value):
+    def convert(self, value):
         if value is not None:
+            # works with bytes as well
             try:
-                value = int(value)
+                number = int(value)
             except ValueError:
-                super().__set__(instance, value)
-                raise RecordError(f'Value "{value}" is not numeric')
-            if not 0 <= value < 10 ** self._size:
-                super().__set__(instance, value)
-                raise FieldError(
-                    f'Not between 0 "{value}" and "{10 ** self._size - 1}"')
-        super().__set__(instance, value)
+                if isinstance(value, bytes):
+                    value = value.decode('latin1')
+                converted, error = super().convert(value)
+                return converted, error or (ERROR_NOT_NUMERIC, value)
+            if not 0 <= number < 10 ** self._size:
+                converted, error = super().convert(number)
+                return converted, error or (ERROR_OUT_OF_RANGE, number)
+            value = number
+        return super().convert(value)
+
+    def get_error(self, code, value=None):
+        if code == ERROR_NOT_NUMERIC:
+            return RecordError(f'Value "{value}" is not numeric')
+        if code == ERROR_OUT_OF_RANGE:
+            return FieldError(
+                f'Not between 0 "{value}" and "{10 ** self._size - 1}"')
+        return super().get_error(code, value)
 
     def to_edi(self, value):
         """Return EDI format."""
@@ -140,12 +279,24 @@ class EdiConstantField(EdiField):
             self._constant = ' ' * size
         super().__init__(size, *args, **kwargs)
 
-    def __set__(self, instance, value):
+    ascii_only = True
+
+    def is_cacheable(self):
+        return True
+
+    def convert(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('latin1')
+        converted, error = super().convert(value)
         if value != self._constant:
-            super().__set__(instance, value)
-            raise FieldWarning(
+            return converted, error or (ERROR_NOT_CONSTANT, value)
+        return converted, error
+
+    def get_error(self, code, value=None):
+        if code == ERROR_NOT_CONSTANT:
+            return FieldWarning(
                 f'Value must be "{self._constant}", not "{value}"')
-        super().__set__(instance, value)
+        return super().get_error(code, value)
 
 
 class EdiListField(EdiField):
@@ -158,14 +309,26 @@ class EdiListField(EdiField):
         self._edi_keys = self._choices.keys()
         super().__init__(size, *args, **kwargs)
 
-    def __set__(self, instance, value):
+    ascii_only = True
+
+    def is_cacheable(self):
+        return True
+
+    def convert(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('latin1')
         if isinstance(value, str):
             value = value.strip()
-        if value and value not in self._choices.keys():
-            super().__set__(instance, value)
+        if value and value not in self._choices:
+            converted, error = super().convert(value)
+            return converted, error or (ERROR_NOT_IN_LIST, value)
+        return super().convert(value)
+
+    def get_error(self, code, value=None):
+        if code == ERROR_NOT_IN_LIST:
             keys = ', '.join(self._edi_keys)
-            raise FieldError(f'Value must be one of "{ keys }"')
-        super().__set__(instance, value)
+            return FieldError(f'Value must be one of "{ keys }"')
+        return super().get_error(code, value)
 
     def verbose(self, value):
         return self._choices.get(value) or value
@@ -183,6 +346,8 @@ class EdiFlagField(EdiListField):
     """Flag field is basically a null-boolean."""
 
     verbose_type = 'Flag field'
+    EDI_VALUES = {'Y': True, 'N': False, 'U': None, ' ': None}
+    VALUES_EDI = {True: 'Y', False: 'N'}
 
     def __init__(self, *args, **kwargs):
         size = 1
@@ -190,27 +355,26 @@ class EdiFlagField(EdiListField):
         super().__init__(size=size, choices=choices, *args, **kwargs)
         self._edi_keys = ('Y', 'N', 'U')
 
-    def __set__(self, instance, value):
+    def convert(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('latin1')
         if self._mandatory and value == 'U':
             # Unknown resolves to None, so super() makes no sense
-            instance.__dict__[self._name] = None
-            return
-        value = dict(
-            (('Y', True), ('N', False), ('U', None), (' ', None))
-        ).get(value, value)
-        super().__set__(instance, value)
+            return None, None
+        return super().convert(self.EDI_VALUES.get(value, value))
 
     def to_edi(self, value):
-        value = dict((
-            (True, 'Y'), (False, 'N'), (None, 'U' if self._mandatory else ' ')
-        )).get(value, ' ')
-        return value
+        if value is None:
+            return 'U' if self._mandatory else ' '
+        return self.VALUES_EDI.get(value, ' ')
 
 
 class EdiBooleanField(EdiListField):
     """Boolean field."""
 
     verbose_type = 'Boolean field'
+    EDI_VALUES = {'Y': True, 'N': False, ' ': None}
+    VALUES_EDI = {True: 'Y', False: 'N', None: ' '}
 
     def __init__(self, *args, **kwargs):
         size = 1
@@ -218,14 +382,10 @@ class EdiBooleanField(EdiListField):
         super().__init__(size=size, choices=choices, *args, **kwargs)
         self._edi_keys = ('Y', 'N')
 
-    def __set__(self, instance, value):
-        value = dict((
-            ('Y', True), ('N', False), (' ', None)
-        )).get(value, value)
-        super().__set__(instance, value)
+    def convert(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('latin1')
+        return super().convert(self.EDI_VALUES.get(value, value))
 
     def to_edi(self, value):
-        value = dict((
-            (True, 'Y'), (False, 'N'), (None, ' ')
-        )).get(value, ' ')
-        return value
+        return self.VALUES_EDI.get(value, ' ')
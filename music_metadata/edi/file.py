@@ -5,15 +5,40 @@ most notably Common Works Registration (CWR) and Common Royalty Distribution
 
 This file contains the file and group handling."""
 
+import codecs
+import collections
 import io
+import os
 # import re
+from concurrent.futures import ProcessPoolExecutor
 from weakref import ref
 
+from .errors import ErrorList
+from .index import EdiIndex, get_fingerprint
+from .reader import (
+    DECODING_ERRORS, EdiAsyncReader, EdiBytesReader, EdiStreamReader,
+    detect_compression)
 from .records import *
 from .transactions import EdiTransaction
 import warnings
 
 
+def build_transactions(transaction_class, gtype, batch, **kwargs):
+    """Create transactions from a batch of (lines, sequence) tuples.
+
+    Used in worker processes."""
+    return [
+        transaction_class(gtype, lines, sequence, **kwargs)
+        for lines, sequence in batch]
+
+
+def line_text(line, encoding='latin1'):
+    """Return the line as text, lines are bytes in byte-level parsing."""
+    if isinstance(line, bytes):
+        return line.decode(encoding, DECODING_ERRORS)
+    return line
+
+
 class EdiGroup(object):
     """Parent class for all EDI Group types.
 
@@ -36,6 +61,11 @@ class EdiGroup(object):
         self.transaction_count = 0
         self.record_count = 2  # header and trailer not counted
         self._file = None
+        self._skipped = None
+        self._transaction = None  # the last one yielded, see checkpoint
+        # default filters for get_transactions, set by EdiFile.get_groups
+        self.transaction_types = None
+        self.record_types = None
 
     @property
     def type(self):
@@ -49,74 +79,266 @@ class EdiGroup(object):
         return str(self.type)
 
     def file(self, f=None):
-        """Set file as weak reference."""
+        """Set the file, return the file, None if not set.
+
+        In streaming mode, it is a weak reference, so the group does not
+        keep the file alive, and None is returned once the file is gone."""
         if f:
-            self._file = ref(f)()
+            self._file = ref(f) if f.streaming else f
+        if isinstance(self._file, ref):
+            return self._file()
         return self._file
 
-    def get_transactions(self):
-        """Iterate through transactions."""
+    def checkpoint(self):
+        """Return the group state for EdiFile.checkpoint."""
+        f = self.file()
+        encoding = f.data_encoding if f else 'latin1'
+        return {
+            'header_line': line_text(self.header_line, encoding),
+            'trailer_line': line_text(self.trailer_line, encoding),
+            'finished': f is None or f.current_group is not self,
+            'transaction_count': self.transaction_count,
+            'record_count': self.record_count,
+            'valid': self.valid,
+            'errors': [str(e) for e in self.errors],
+            # checked with the trailer, if it is the last one
+            'transaction_errors': [
+                str(e) for e in self._transaction.errors
+                if isinstance(e, FileError)] if self._transaction else [],
+        }
+
+    @classmethod
+    def from_checkpoint(cls, state, f):
+        """Create the group from the state in a checkpoint."""
+        group = cls(state['header_line'])
+        group.file(f)
+        group.transaction_count = state['transaction_count']
+        group.record_count = state['record_count']
+        if state['trailer_line']:
+            group.trailer(state['trailer_line'])
+        group.valid = state['valid']
+        group.errors = f.get_error_list(
+            f'group {group.sequence}',
+            [FileError(e) for e in state['errors']])
+        if state.get('transaction_errors'):
+            # the last transaction, without records
+            group._transaction = EdiTransaction(str(group.type))
+            group._transaction.errors = [
+                FileError(e) for e in state['transaction_errors']]
+        return group
+
+    def get_transaction_lines(self):
+        """Iterate through lines of transactions, yield (lines, sequence).
+
+        Records and transactions are counted, but not created. Iteration
+        stops at the group trailer, which is not consumed."""
 
         f = self.file()
-        sequence = 0
-        current_transaction_lines = []
+        tags = f.tag('GRT'), f.tag(str(self.type))
+        lines = []
+
+        # current line should be the first line of the first transaction
+        while f.current_line:
+            yield from self.scan_transaction_line(f.current_line, tags, lines)
+            if f.current_line[0:3] == tags[0]:
+                return
+            f.readline()
+
+    def scan_transaction_line(self, line, tags, lines):
+        """Process a line for get_transaction_lines and its asynchronous
+        version, tags are the group trailer and transaction prefixes.
+
+        Yield (lines, sequence) of the transaction the line finishes, if
+        any, then add the line to lines of the current transaction, unless
+        it is the group trailer."""
+        grt, gtype = tags
+        if line[0:3] == grt or line[0:3] == gtype:
+            if lines:
+                # not 0 if resumed from a checkpoint
+                sequence = self.transaction_count
+                self.transaction_count += 1
+                yield lines.copy(), sequence
+                lines.clear()
+            if line[0:3] == grt:
+                return
+        lines.append(line)
+        self.record_count += 1
+
+    def get_transactions(self, transaction_types=None, record_types=None):
+        """Iterate through transactions.
+
+        If transaction_types is set, other transactions are skipped by the
+        record type of the first line, without creating records. If
+        record_types is set, it is passed to transactions (see
+        EdiTransaction). Both default to filters set by EdiFile.get_groups.
+        Transactions and records are counted and checked with the trailer
+        as without filters.
 
+        If the file has workers set, transactions are parsed in a process
+        pool, but still returned in the original order.
+
+        In streaming mode, records of each transaction are released when
+        the next one is requested."""
+
+        f = self.file()
+        if f is None:
+            raise RuntimeError('The file of this group is not available.')
         if f.current_group != self:
             raise RuntimeError(
                 'get_transactions was already run for this group.')
-        # current line should be the first line of the first transaction
+
+        if transaction_types is None:
+            transaction_types = self.transaction_types
+        if record_types is None:
+            record_types = self.record_types
+        self._skipped = None
+        transaction_lines = self.get_transaction_lines()
+        if transaction_types is not None:
+            transaction_lines = self.filter_transaction_lines(
+                transaction_lines, transaction_types)
+        if f.workers:
+            transactions = self.build_transactions_in_pool(
+                transaction_lines, record_types)
+        else:
+            transactions = (
+                self.build_transaction(lines, sequence, record_types)
+                for lines, sequence in transaction_lines)
+        streaming = f.streaming
+        transaction = self._transaction  # if resumed from a checkpoint
+        for transaction in transactions:
+            self._transaction = transaction
+            yield transaction
+            if streaming:
+                transaction.release()
+        if self._skipped is not None:
+            # sequences of the last transaction are checked with the trailer
+            transaction = self.build_transaction(
+                *self._skipped, record_types=())
+            self._skipped = None
+
+        self._transaction = None
+
+        if f.current_line[0:3] == f.tag('GRT'):
+            self.validate_trailer(f.current_line, transaction)
+            # mark as not being processed
+            f.current_group = None
+
+    def filter_transaction_lines(self, transaction_lines, transaction_types):
+        """Yield (lines, sequence) only for transactions of given types.
+
+        The last skipped transaction is kept in _skipped, until one is not
+        skipped."""
+        tags = set(self.file().tag(t) for t in transaction_types)
+        for lines, sequence in transaction_lines:
+            if lines[0][0:3] in tags:
+                self._skipped = None
+                yield lines, sequence
+            else:
+                self._skipped = (lines, sequence)
+
+    async def aget_transaction_lines(self):
+        """Asynchronous version of get_transaction_lines."""
+
+        f = self.file()
+        tags = f.tag('GRT'), f.tag(str(self.type))
+        lines = []
         while f.current_line:
-            if f.current_line[0:3] == 'GRT':
-                if current_transaction_lines:
-                    transaction_class = self.get_transaction_class()
-                    transaction = transaction_class(
-                        str(self.type), current_transaction_lines, sequence)
-                    self.transaction_count += 1
-                    yield transaction
-                    sequence += 1
-                # add the trailer and process transaction errors
-                trailer = self.trailer(f.current_line)
-                for error in transaction.errors:
-                    if isinstance(error, FileError):
-                        self.valid = False
-                        self.errors.append(error)
-                        self.file().valid = False
-                        self.file().file_errors.append(error)
-                trailer = self.trailer()
-                if self.transaction_count != trailer.transaction_count:
-                    self.valid = False
-                    self.file().valid = False
-                    e = FileError(
-                        f'Wrong transaction count in GRT: '
-                        f'{trailer.transaction_count}, counted '
-                        f'{self.transaction_count}')
-                    self.errors.append(e)
-                    trailer.error('transaction_count', e)
-                if self.record_count != trailer.record_count:
+            for transaction_lines in self.scan_transaction_line(
+                    f.current_line, tags, lines):
+                yield transaction_lines
+            if f.current_line[0:3] == tags[0]:
+                return
+            await f.areadline()
+
+    def __aiter__(self):
+        return self.aget_transactions()
+
+    async def aget_transactions(self):
+        """Asynchronous version of get_transactions, for files created
+        with EdiFile.from_stream."""
+
+        f = self.file()
+        if f is None:
+            raise RuntimeError('The file of this group is not available.')
+        if f.current_group != self:
+            raise RuntimeError(
+                'get_transactions was already run for this group.')
+
+        transaction = None
+        async for lines, sequence in self.aget_transaction_lines():
+            transaction = self.build_transaction(lines, sequence)
+            self._transaction = transaction
+            yield transaction
+
+        self._transaction = None
+
+        if f.current_line[0:3] == f.tag('GRT'):
+            self.validate_trailer(f.current_line, transaction)
+            # mark as not being processed
+            f.current_group = None
+
+    def validate_trailer(self, trailer_line, transaction=None):
+        """Add the trailer, check counts and process transaction errors."""
+        trailer = self.trailer(trailer_line)
+        if transaction is not None:
+            for error in transaction.errors:
+                if isinstance(error, FileError):
                     self.valid = False
+                    self.errors.append(error)
                     self.file().valid = False
-                    e = FileError(
-                        f'Wrong record count in GRT: '
-                        f'{trailer.record_count}, counted '
-                        f'{self.record_count}')
-                    self.errors.append(e)
-                    trailer.error('record_count', e)
-
-                # mark as not being processed
-                f.current_group = None
-                return
-            if f.current_line[0:3] == str(self.type):
-                if current_transaction_lines:
-                    transaction_class = self.get_transaction_class()
-                    transaction = transaction_class(
-                        str(self.type), current_transaction_lines, sequence)
-                    self.transaction_count += 1
-                    yield transaction
-                    sequence += 1
-                    current_transaction_lines = []
-            current_transaction_lines.append(f.current_line)
-            self.record_count += 1
-            f.readline()
+                    self.file().file_errors.append(error)
+        trailer = self.trailer()
+        if self.transaction_count != trailer.transaction_count:
+            self.valid = False
+            self.file().valid = False
+            e = FileError(
+                f'Wrong transaction count in GRT: '
+                f'{trailer.transaction_count}, counted '
+                f'{self.transaction_count}')
+            self.errors.append(e)
+            trailer.error('transaction_count', e)
+        if self.record_count != trailer.record_count:
+            self.valid = False
+            self.file().valid = False
+            e = FileError(
+                f'Wrong record count in GRT: '
+                f'{trailer.record_count}, counted '
+                f'{self.record_count}')
+            self.errors.append(e)
+            trailer.error('record_count', e)
+
+    def build_transactions_in_pool(self, transaction_lines,
+                                   record_types=None):
+        """Create transactions in the process pool of the file.
+
+        Transactions are sent in batches, with a limited number of batches
+        in progress, and returned in the original order. Lazy mode is not
+        used in this case."""
+        f = self.file()
+        executor = f.get_executor()
+        transaction_class = self.get_transaction_class()
+        gtype = str(self.type)
+        kwargs = {'encoding': f.data_encoding} if f.bytes_mode else {}
+        if record_types is not None:
+            kwargs['record_types'] = record_types
+        in_progress = collections.deque()
+        batch = []
+        for lines, sequence in transaction_lines:
+            batch.append((lines, sequence))
+            if len(batch) < f.batch_size:
+                continue
+            in_progress.append(executor.submit(
+                build_transactions, transaction_class, gtype, batch,
+                **kwargs))
+            batch = []
+            if len(in_progress) > f.workers * 2:
+                yield from in_progress.popleft().result()
+        if batch:
+            in_progress.append(executor.submit(
+                build_transactions, transaction_class, gtype, batch,
+                **kwargs))
+        while in_progress:
+            yield from in_progress.popleft().result()
 
     def get_file(self):
         warnings.warn('Use EdiGroup.file() instead', DeprecationWarning)
@@ -161,68 +383,241 @@ class EdiGroup(object):
         warnings.warn('Use EdiGroup.trailer() instead', DeprecationWarning)
         return self.trailer()
 
+    def build_transaction(self, lines, sequence, record_types=None):
+        """Create the transaction object from its lines. Transactions with
+        record_types set are not cached."""
+        transaction_class = self.get_transaction_class()
+        f = self.file()
+        kwargs = {}
+        if record_types is not None:
+            kwargs['record_types'] = record_types
+        if f is not None:
+            if f.lazy:
+                kwargs['lazy'] = True
+            if f.bytes_mode:
+                kwargs['encoding'] = f.data_encoding
+            if f.cache is not None and record_types is None:
+                return f.cache.build_transaction(
+                    transaction_class, str(self.type), lines, sequence,
+                    **kwargs)
+        return transaction_class(str(self.type), lines, sequence, **kwargs)
+
+    @classmethod
+    def get_transaction_class_map(cls):
+        """Return the mapping of group types to transaction classes.
+
+        It is built from transaction_classes once per group class."""
+        if cls.__dict__.get('_transaction_class_map') is None:
+            cls._transaction_class_map = {}
+            for transaction_class in cls.transaction_classes:
+                cls._transaction_class_map.setdefault(
+                    transaction_class.record_type, transaction_class)
+        return cls._transaction_class_map
+
     def get_transaction_class(self):
-        for transaction_class in self.transaction_classes:
-            if self.type == transaction_class.record_type:
-                return transaction_class
-        return EdiTransaction
+        return self.get_transaction_class_map().get(
+            self.type, EdiTransaction)
 
     def list_transactions(self):
         return list(self.get_transactions())
 
 
 class EdiFile(io.TextIOWrapper):
+    """Base class for all EDI files.
+
+    If lazy is set, transactions and records are created in lazy mode, so
+    fields are only decoded when accessed.
+
+    Lines are read with EdiBytesReader (memory-mapped) when the buffer
+    allows it, unless use_mmap is unset.
+
+    Compressed files (gzip, zip, bz2, xz) are detected from magic bytes and
+    decompressed while reading, in chunks, with EdiStreamReader. For zip
+    archives with several files, member selects the file.
+
+    If workers is set, transactions are parsed in a process pool with that
+    many workers, in batches of batch_size transactions.
+
+    With EdiBytesReader, a byte-offset index can be built (see get_index),
+    for random access to groups and transactions.
+
+    Data is decoded with the encoding for the character set in the header
+    (see get_encoding_from_header), with all readers. Bytes not valid in
+    that encoding are decoded as latin1. If bytes_mode is set, lines are not
+    decoded at all, records are created from bytes, so only alphanumeric
+    fields are decoded, when accessed. It requires EdiBytesReader.
+
+    If cache (EdiTransactionCache) is set, transactions already parsed,
+    e.g. in a previous file, are taken from it. It is not used by workers.
+
+    Errors in file_errors and group errors are limited to max_errors per
+    list, the rest is passed to error_sink(error, context), if set, see
+    ErrorList.
+
+    In streaming mode, memory use does not depend on the file size: the
+    file is read in chunks (EdiStreamReader), not memory-mapped, records of
+    transactions are released once the next transaction is requested (see
+    EdiTransaction.release), groups only keep a weak reference to the file,
+    and max_errors defaults to streaming_max_errors.
+    """
+
     header_class = EdiHDR
     trailer_class = EdiTRL
     group_class = EdiGroup
+    batch_size = 100
+    streaming_max_errors = 100
+
+    # Dispatch cache, cleared whenever a file class is defined
+    _dispatch_cache = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        EdiFile._dispatch_cache.clear()
 
     @classmethod
     def is_my_header(cls, hdr):
         return False
 
+    @classmethod
+    def get_file_classes(cls):
+        """Return descendant classes (at any depth) that define their own
+        is_my_header, the most derived ones first."""
+        try:
+            return EdiFile._dispatch_cache[cls]
+        except KeyError:
+            classes = []
+            pending = list(reversed(cls.__subclasses__()))
+            while pending:
+                c = pending.pop()
+                if c not in classes and 'is_my_header' in c.__dict__:
+                    classes.append(c)
+                pending.extend(reversed(c.__subclasses__()))
+            classes.sort(key=lambda c: len(c.__mro__), reverse=True)
+            EdiFile._dispatch_cache[cls] = tuple(classes)
+            return EdiFile._dispatch_cache[cls]
+
+    @classmethod
+    def get_file_class(cls, hdr):
+        """Return the file class for the header line, most derived first."""
+        for file_class in cls.get_file_classes():
+            if file_class.is_my_header(hdr):
+                return file_class
+        return cls
+
     def readline(self):
+        if self._reader is not None:
+            if self.bytes_mode:
+                line = self._reader.readline_bytes()
+            else:
+                line = self._reader.readline()
+            self.current_line = line
+            return line
         if self.seekable() and self.position > self.tell():
             self.seek(self.position)
         line = super().readline().strip('\n')
+        if self._recode:
+            line = line.encode(self.encoding).decode(
+                self.data_encoding, DECODING_ERRORS)
         self.current_line = line
         if self.seekable():
             self.position = self.tell()
         return line
 
-    def __init__(self, buffer=None, encoding='latin1', *args, **kwargs):
+    def __init__(self, buffer=None, encoding='latin1', *args, lazy=False,
+                 use_mmap=True, workers=None, cache=None, bytes_mode=False,
+                 member=None, streaming=False, max_errors=None,
+                 error_sink=None, **kwargs):
         if buffer is None:
             existing_file = False
             buffer = io.BytesIO()
         else:
             existing_file = True
         super().__init__(buffer, encoding=encoding, *args, **kwargs)
+        self._reader = None
+        self._stream = None
+        compression = detect_compression(buffer) if existing_file else None
+        if compression or (existing_file and streaming):
+            self._reader = EdiStreamReader.from_buffer(
+                buffer, compression, encoding, member)
+        elif existing_file and use_mmap:
+            self._reader = EdiBytesReader.from_buffer(buffer, encoding)
+        self.lazy = lazy
+        self.bytes_mode = False
+        self.data_encoding = encoding
+        self._recode = False
+        self.workers = workers
+        self.cache = cache
+        self._executor = None
+        self.streaming = streaming
+        if streaming and max_errors is None:
+            max_errors = self.streaming_max_errors
+        self.max_errors = max_errors
+        self.error_sink = error_sink
         self.valid = True
-        self.file_errors = []
+        self.file_errors = self.get_error_list('file')
         self.group_count = 0
         self.transaction_count = 0
         self.record_count = 2
         if self.seekable():
             self.position = self.tell()
         self.header_line = self.readline()
+        # position of the first group, see validate_structure and checkpoint
+        if self._reader is not None:
+            self._body_position = self._reader.tell()
+        elif self.seekable():
+            self._body_position = self.position
+        self._offset_index = None
         self.trailer_line = ''
         self.current_line = self.header_line
         self._header = None
         self._trailer = None
         self.current_group = None
+        self.group_sequence = 0
+        self._group = None  # yielded by get_groups, not counted yet
         if existing_file:
-            for child_class in self.__class__.__subclasses__():
-                if child_class.is_my_header(self.header_line):
-                    self.__class__ = child_class
+            self.__class__ = self.get_file_class(self.header_line)
             self.header()
+            self.data_encoding = self.get_encoding_from_header()
+            if self._reader is not None:
+                self._reader.encoding = self.data_encoding
+            else:
+                # lines are decoded by the text wrapper
+                self._recode = (
+                    codecs.lookup(self.data_encoding).name !=
+                    codecs.lookup(self.encoding).name)
+        if bytes_mode:
+            if self._reader is None:
+                raise ValueError(
+                    'Byte-level parsing requires a memory-mapped, in-memory '
+                    'or compressed file.')
+            self.bytes_mode = True
 
     def __str__(self):
         return self.name
 
+    def close(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if getattr(self, '_reader', None) is not None:
+            self._reader.close()
+            self._reader = None
+        super().close()
+
+    def get_error_list(self, context, errors=()):
+        """Return the list for errors, limited to max_errors."""
+        return ErrorList(errors, self.max_errors, self.error_sink, context)
+
+    def get_executor(self):
+        """Return the process pool, create it if needed."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
     def header(self):
         if self._header:
             return self._header
         self._header = self.header_class(self.header_line)
-        # self.reconfigure(encoding=self.get_encoding_from_header())
         return self._header
 
     def get_header(self):
@@ -238,78 +633,234 @@ class EdiFile(io.TextIOWrapper):
         warnings.warn('Use EdiFile.trailer() instead', DeprecationWarning)
         return self.trailer()
 
-    def get_groups(self):
-        expected_sequence = 0
-        self.readline()
-        while self.current_line:
-            # End of file, break
-            if self.current_line[0:3] == 'TRL':
-                self.trailer_line = self.current_line
-                trailer = self.trailer()
-                if self.transaction_count != trailer.transaction_count:
-                    self.valid = False
-                    e = FileError(
-                        f'Wrong transaction count in TRL: '
-                        f'{trailer.transaction_count}, counted '
-                        f'{self.transaction_count}')
-                    self.file_errors.append(e)
-                    trailer.error('transaction_count', e)
-                if self.record_count != trailer.record_count:
-                    self.valid = False
-                    e = FileError(
-                        f'Wrong record count in TRL: '
-                        f'{trailer.record_count}, counted '
-                        f'{self.record_count}')
-                    self.file_errors.append(e)
-                    trailer.error('record_count', e)
-                if expected_sequence != trailer.group_count:
-                    self.valid = False
-                    e = FileError(
-                        'Wrong group count in TRL: '
-                        f'{trailer.group_count}, '
-                        f'counted {expected_sequence}')
-                    self.file_errors.append(e)
-                    trailer.error('group_count', e)
+    def validate_trailer(self, trailer_line, group_count):
+        """Add the file trailer and check counts."""
+        self.trailer_line = trailer_line
+        trailer = self.trailer()
+        if self.transaction_count != trailer.transaction_count:
+            self.valid = False
+            e = FileError(
+                f'Wrong transaction count in TRL: '
+                f'{trailer.transaction_count}, counted '
+                f'{self.transaction_count}')
+            self.file_errors.append(e)
+            trailer.error('transaction_count', e)
+        if self.record_count != trailer.record_count:
+            self.valid = False
+            e = FileError(
+                f'Wrong record count in TRL: '
+                f'{trailer.record_count}, counted '
+                f'{self.record_count}')
+            self.file_errors.append(e)
+            trailer.error('record_count', e)
+        if group_count != trailer.group_count:
+            self.valid = False
+            e = FileError(
+                'Wrong group count in TRL: '
+                f'{trailer.group_count}, '
+                f'counted {group_count}')
+            self.file_errors.append(e)
+            trailer.error('group_count', e)
 
-                self.readline()
-                break
+    def start_group(self, header_line, expected_sequence):
+        """Create the group from the header line, make it the current group
+        and check the sequence."""
+
+        # The line must be GRH, if not, it is a bad file.
+        if header_line[0:3] != self.tag('GRH'):
+            e = FileError('Group header missing for group {}'.format(
+                expected_sequence))
+            self.valid = False
+            self.file_errors.append(e)
+            raise e
+
+        group = self.group_class(header_line)
+        group.errors = self.get_error_list(f'group {expected_sequence}')
+        # set file to the group (it's a weak reference)
+        group.file(self)
+
+        # EDIGroup.get_transactions will unset this variable
+        self.current_group = group
+
+        # check sequence
+        if group.sequence != expected_sequence:
+            e = FileError('Group sequence mismatch {} vs {}'.format(
+                expected_sequence, group.sequence))
+            self.valid = False
+            self.file_errors.append(e)
+        return group
 
-            # Next group
-            expected_sequence += 1
+    def get_groups(self, checkpoint=None, group_types=None,
+                   transaction_types=None, record_types=None):
+        """Iterate through groups.
 
-            # The next line must be GRH, if not, it is a bad file.
-            if self.current_line[0:3] != 'GRH':
-                e = FileError('Group header missing for group {}'.format(
-                    expected_sequence))
+        If checkpoint (see EdiFile.checkpoint) is set, parsing resumes from
+        it, starting with the group in progress, if any. A group finished
+        before the checkpoint is not yielded again.
+
+        If group_types is set, other groups are not yielded, their lines
+        are read without creating transactions. Transaction_types and
+        record_types are set as default filters for get_transactions of
+        yielded groups. Counts and trailers are validated as without
+        filters."""
+        if checkpoint is None:
+            self.group_sequence = 0
+            self.readline()
+            group = None
+        else:
+            group = self.restore_checkpoint(checkpoint)
+            if self.trailer_line:
+                return
+        trl = self.tag('TRL')
+        while True:
+            if group is not None:
+                group.transaction_types = transaction_types
+                group.record_types = record_types
+                if group is not self.current_group:
+                    # finished before the checkpoint, only counted
+                    pass
+                elif group_types is None or group.type in group_types:
+                    self._group = group
+                    yield group
+
+                    # lines must be read, if not read already
+                    if self.current_group:
+                        collections.deque(
+                            self.current_group.get_transactions(),
+                            maxlen=0)
+                else:
+                    collections.deque(
+                        group.get_transactions(transaction_types=()),
+                        maxlen=0)
+                self.transaction_count += group.transaction_count
+                self.record_count += group.record_count
+                self._group = None
+                self.readline()
+
+            if not self.current_line:
+                e = FileError('File trailer missing')
                 self.valid = False
                 self.file_errors.append(e)
-                raise e
+                break
 
-            # create the new group, consume this line
-            group = self.group_class(self.current_line)
+            # End of file, break
+            if self.current_line[0:3] == trl:
+                self.validate_trailer(self.current_line, self.group_sequence)
+                self.readline()
+                break
+
+            # Next group, consume the header line
+            self.group_sequence += 1
+            group = self.start_group(self.current_line, self.group_sequence)
             self.readline()
-            # set file to the group (it's a weak reference)
-            group.file(self)
 
-            # EDIGroup.get_transactions will unset this variable
+    def checkpoint(self):
+        """Return the parsing state as a JSON-serializable dictionary.
+
+        It should be taken between transactions, i.e. while processing a
+        group or a transaction yielded by get_groups or get_transactions,
+        which are then considered done. Parsing can be resumed from it with
+        get_groups(checkpoint=...), also with a new EdiFile object for the
+        same file, e.g. in another process."""
+        if self._reader is None:
+            raise RuntimeError('Checkpoints require a memory-mapped file.')
+        if self.workers and self.current_group is not None:
+            raise RuntimeError(
+                'Checkpoints are not supported while transactions are '
+                'parsed by workers.')
+        if self._group is None and not self.group_sequence:
+            # not started yet
+            position = self._body_position
+        else:
+            position = self._reader.line_position
+        return {
+            'size': self._reader.size,
+            'position': position,
+            'group_sequence': self.group_sequence,
+            'transaction_count': self.transaction_count,
+            'record_count': self.record_count,
+            'valid': self.valid,
+            'file_errors': [str(e) for e in self.file_errors],
+            'trailer_line': line_text(self.trailer_line, self.data_encoding),
+            'group': self._group.checkpoint() if self._group else None,
+        }
+
+    def restore_checkpoint(self, checkpoint):
+        """Restore the parsing state, return the group in progress."""
+        if self._reader is None:
+            raise RuntimeError('Checkpoints require a memory-mapped file.')
+        if checkpoint['size'] != self._reader.size:
+            raise ValueError('Checkpoint is for a different file.')
+        self.group_sequence = checkpoint['group_sequence']
+        self.transaction_count = checkpoint['transaction_count']
+        self.record_count = checkpoint['record_count']
+        self.valid = checkpoint['valid']
+        self.file_errors = self.get_error_list(
+            'file', [FileError(e) for e in checkpoint['file_errors']])
+        self.trailer_line = checkpoint['trailer_line']
+        self._trailer = None
+        self._reader.seek(checkpoint['position'])
+        self.readline()
+        self.current_group = None
+        if checkpoint['group'] is None:
+            return None
+        group = self.group_class.from_checkpoint(checkpoint['group'], self)
+        if not checkpoint['group']['finished']:
             self.current_group = group
+        return group
 
-            # check sequence
-            if group.sequence != expected_sequence:
-                e = FileError('Group sequence mismatch {} vs {}'.format(
-                    expected_sequence, group.sequence))
-                self.valid = False
-                self.file_errors.append(e)
+    @classmethod
+    async def from_stream(cls, stream, encoding='latin1', *, lazy=False,
+                          cache=None):
+        """Create the file from an asyncio.StreamReader or an asynchronous
+        iterable of byte chunks. Only the header line is read here.
+
+        Use "async for group in f" and "async for transaction in group",
+        validation is the same as with get_groups and get_transactions.
+        Transactions are always parsed in the current process."""
+        reader = EdiAsyncReader(stream, encoding)
+        header_line = await reader.readline()
+        f = cls(io.BytesIO(header_line.encode(encoding)), encoding,
+                lazy=lazy, cache=cache)
+        reader.encoding = f.data_encoding
+        f._stream = reader
+        return f
+
+    async def areadline(self):
+        """Read the next line from the asynchronous stream."""
+        line = await self._stream.readline()
+        self.current_line = line
+        return line
+
+    def __aiter__(self):
+        return self.aget_groups()
+
+    async def aget_groups(self):
+        """Asynchronous version of get_groups, see from_stream."""
+        if self._stream is None:
+            raise RuntimeError('File was not created with from_stream.')
+        self.group_sequence = 0
+        await self.areadline()
+        trl = self.tag('TRL')
+        while self.current_line:
+            if self.current_line[0:3] == trl:
+                self.validate_trailer(self.current_line, self.group_sequence)
+                await self.areadline()
+                break
+
+            self.group_sequence += 1
+            group = self.start_group(self.current_line, self.group_sequence)
+            await self.areadline()
 
             yield group
-            self.transaction_count += group.transaction_count
-            self.record_count += group.record_count
 
-            # lines must be read, if not read already
             if self.current_group:
-                self.current_group.list_transactions()
+                async for transaction in self.current_group:
+                    pass
+            self.transaction_count += group.transaction_count
+            self.record_count += group.record_count
 
-            self.readline()
+            await self.areadline()
         else:
             e = FileError('File trailer missing')
             self.valid = False
@@ -318,5 +869,247 @@ class EdiFile(io.TextIOWrapper):
     def list_groups(self):
         return list(self.get_groups())
 
+    def iter_html(self):
+        """Yield HTML representation of the whole file in chunks, one line
+        per record. This consumes groups and transactions."""
+        yield self.header().to_html() + '\n'
+        for group in self.get_groups():
+            yield group.header().to_html() + '\n'
+            for transaction in group.get_transactions():
+                yield from transaction.iter_html()
+            if group.trailer():
+                yield group.trailer().to_html() + '\n'
+        if self.trailer_line:
+            yield self.trailer().to_html() + '\n'
+
+    def validate_structure(self):
+        """Validate the file structure only, without creating records.
+
+        Group sequence, transaction and record sequence numbers, and
+        counts in group and file trailers are checked, using only line
+        prefixes and field positions. Returns the list of all FileErrors,
+        with the same messages as in full parsing. Missing group header
+        raises FileError.
+
+        The whole file is validated, also if parsing has started. File
+        state is not changed, and the position is restored, so parsing can
+        continue afterwards. RuntimeError is raised if the file is not
+        seekable, e.g. a pipe."""
+        if self._reader is not None:
+            position = self._reader.tell()
+            self._reader.seek(self._body_position)
+        elif self.seekable():
+            position = self.position
+            self.seek(self._body_position)
+            self.position = self._body_position
+        else:
+            raise RuntimeError(
+                'Structure validation requires a seekable file.')
+        current_line = self.current_line
+        bytes_mode = self.bytes_mode
+        self.bytes_mode = False
+        try:
+            return self._validate_structure()
+        finally:
+            self.bytes_mode = bytes_mode
+            if self._reader is not None:
+                self._reader.seek(position)
+            else:
+                self.seek(position)
+                self.position = position
+            self.current_line = current_line
+
+    def _validate_structure(self):
+        errors = []
+        group_count = 0
+        transaction_count = 0
+        record_count = 2
+        record_class = EdiTransactionRecord
+        group_header_class = self.group_class.header_class
+        group_trailer_class = self.group_class.trailer_class
+        line = self.readline()
+        while line:
+            if line[0:3] == 'TRL':
+                trailer_transactions = peek_number(
+                    self.trailer_class, line, 'transaction_count')
+                trailer_records = peek_number(
+                    self.trailer_class, line, 'record_count')
+                trailer_groups = peek_number(
+                    self.trailer_class, line, 'group_count')
+                if transaction_count != trailer_transactions:
+                    errors.append(FileError(
+                        f'Wrong transaction count in TRL: '
+                        f'{trailer_transactions}, counted '
+                        f'{transaction_count}'))
+                if record_count != trailer_records:
+                    errors.append(FileError(
+                        f'Wrong record count in TRL: '
+                        f'{trailer_records}, counted '
+                        f'{record_count}'))
+                if group_count != trailer_groups:
+                    errors.append(FileError(
+                        'Wrong group count in TRL: '
+                        f'{trailer_groups}, '
+                        f'counted {group_count}'))
+                break
+
+            group_count += 1
+            if line[0:3] != 'GRH':
+                raise FileError('Group header missing for group {}'.format(
+                    group_count))
+            gtype = group_header_class.peek(line, 'transaction_type')
+            sequence = peek_number(group_header_class, line, 'group_code')
+            if sequence != group_count:
+                errors.append(FileError(
+                    'Group sequence mismatch {} vs {}'.format(
+                        group_count, sequence)))
+
+            group_transactions = 0
+            group_records = 2
+            record_sequence = 0
+            line = self.readline()
+            while line and line[0:3] != 'GRT':
+                if record_sequence and line[0:3] == gtype:
+                    group_transactions += 1
+                    record_sequence = 0
+                value = peek_number(
+                    record_class, line, 'transaction_sequence_number')
+                if value != group_transactions:
+                    errors.append(FileError(
+                        f'Wrong transaction sequence { value }, should be '
+                        f'{ group_transactions }'))
+                value = peek_number(
+                    record_class, line, 'record_sequence_number')
+                if value != record_sequence:
+                    errors.append(FileError(
+                        f'Wrong transaction sequence { value }, should be '
+                        f'{ record_sequence }'))
+                record_sequence += 1
+                group_records += 1
+                line = self.readline()
+            if record_sequence:
+                group_transactions += 1
+            if not line:
+                continue
+
+            trailer_transactions = peek_number(
+                group_trailer_class, line, 'transaction_count')
+            trailer_records = peek_number(
+                group_trailer_class, line, 'record_count')
+            if group_transactions != trailer_transactions:
+                errors.append(FileError(
+                    f'Wrong transaction count in GRT: '
+                    f'{trailer_transactions}, counted '
+                    f'{group_transactions}'))
+            if group_records != trailer_records:
+                errors.append(FileError(
+                    f'Wrong record count in GRT: '
+                    f'{trailer_records}, counted '
+                    f'{group_records}'))
+            transaction_count += group_transactions
+            record_count += group_records
+            line = self.readline()
+        else:
+            errors.append(FileError('File trailer missing'))
+        return errors
+
+    def get_index(self, sidecar=None):
+        """Return the byte-offset index of groups and transactions.
+
+        If sidecar (path) is set, the index is loaded from that file, or
+        built and saved there if the file does not exist or is stale, i.e.
+        size or fingerprint (see get_fingerprint) differ. Without a
+        fingerprint, e.g. for pipes, the sidecar file is not used."""
+        if self._offset_index is not None:
+            return self._offset_index
+        if self._reader is None:
+            raise RuntimeError('Index requires a memory-mapped file.')
+        index = None
+        fingerprint = get_fingerprint(self.buffer) if sidecar else None
+        if fingerprint and os.path.exists(sidecar):
+            try:
+                index = EdiIndex.load(sidecar)
+            except (ValueError, KeyError):
+                index = None
+            else:
+                if (index.size != self._reader.size or
+                        index.fingerprint != fingerprint):
+                    index = None
+        if index is None:
+            position = self._reader.tell()
+            self._reader.seek(self._body_position)
+            index = EdiIndex.build(self._reader)
+            index.fingerprint = fingerprint
+            self._reader.seek(position)
+            if fingerprint:
+                index.save(sidecar)
+        self._offset_index = index
+        return index
+
+    def read_lines(self, start, end):
+        """Return lines between two byte offsets, file state is kept.
+        Lines are bytes in byte-level parsing."""
+        position = self._reader.tell()
+        self._reader.seek(start)
+        if self.bytes_mode:
+            readline = self._reader.readline_bytes
+        else:
+            readline = self._reader.readline
+        lines = []
+        while self._reader.tell() < end:
+            lines.append(readline())
+        self._reader.seek(position)
+        return lines
+
+    def get_indexed_group(self, sequence):
+        """Create the group from the index, without transactions."""
+        index = self.get_index()
+        if not 1 <= sequence <= index.group_count:
+            raise IndexError(f'No group { sequence } in the index')
+        start = index.group_headers[sequence - 1]
+        header_line = self.read_lines(start, start + 1)[0]
+        group = self.group_class(header_line)
+        group.file(self)
+        return group
+
+    def group(self, sequence):
+        """Return the group by its sequence number (from 1), using the index.
+
+        The file is positioned at the first transaction of the group, so
+        get_transactions can be used. Groups can be retrieved again."""
+        group = self.get_indexed_group(sequence)
+        self._reader.seek(self.get_index().group_headers[sequence - 1])
+        self._reader.readline()
+        self.readline()
+        self.current_group = group
+        return group
+
+    def transaction_at(self, n):
+        """Return the n-th transaction in the file (from 0), using the index.
+
+        Only lines of this transaction and its group header are read."""
+        index = self.get_index()
+        start, end = index.get_transaction_span(n)
+        group_number = index.get_group_number(n)
+        group = self.get_indexed_group(group_number)
+        sequence = n - index.group_transactions[group_number - 1]
+        return group.build_transaction(self.read_lines(start, end), sequence)
+
+    def tag(self, prefix):
+        """Return the record type prefix in the form of lines, bytes in
+        byte-level parsing."""
+        if self.bytes_mode:
+            return prefix.encode('latin1')
+        return prefix
+
     def get_encoding_from_header(self):
-        return 'latin1'
+        """Return the encoding for the character set in the header record,
+        if it has one and it is known, otherwise the encoding the file was
+        opened with."""
+        character_set = getattr(self.header(), 'character_set', None)
+        if character_set:
+            try:
+                return codecs.lookup(character_set).name
+            except LookupError:
+                pass
+        return self.encoding
@@ -0,0 +1,144 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the byte-offset index for random access."""
+
+import hashlib
+import io
+import json
+import os
+from array import array
+from bisect import bisect_right
+
+# Size of blocks at the start and the end of the file in fingerprints
+FINGERPRINT_BLOCK = 1 << 16
+
+
+def get_fingerprint(buffer):
+    """Return the fingerprint of a binary buffer, to detect changes that
+    keep the file size: modification time (for files), and hash of the
+    first and last blocks. None if the buffer is not seekable. The position
+    in the buffer is kept."""
+    try:
+        position = buffer.tell()
+        buffer.seek(0)
+        head = buffer.read(FINGERPRINT_BLOCK)
+        size = buffer.seek(0, io.SEEK_END)
+        buffer.seek(max(size - FINGERPRINT_BLOCK, 0))
+        tail = buffer.read(FINGERPRINT_BLOCK)
+        buffer.seek(position)
+    except (OSError, ValueError, AttributeError):
+        return None
+    try:
+        mtime = os.fstat(buffer.fileno()).st_mtime_ns
+    except (OSError, ValueError, AttributeError):
+        mtime = None
+    h = hashlib.blake2b(head, digest_size=16)
+    h.update(tail)
+    return f'{ mtime }:{ h.hexdigest() }'
+
+
+class EdiIndex(object):
+    """Byte offsets of all groups and transactions in a file.
+
+    For each group, offsets of the header and the trailer are kept, as well
+    as the (file-wide) number of its first transaction. Transactions are
+    numbered from 0, groups from 1, as in group headers.
+
+    Size and fingerprint (see get_fingerprint) of the file are kept, to
+    detect stale sidecar files."""
+
+    version = 2
+
+    def __init__(self, size=0, fingerprint=None):
+        self.size = size
+        self.fingerprint = fingerprint
+        self.group_headers = array('Q')
+        self.group_trailers = array('Q')
+        self.group_transactions = array('Q')
+        self.transactions = array('Q')
+
+    @classmethod
+    def build(cls, reader):
+        """Build the index by scanning the lines of EdiBytesReader.
+
+        Reader must be positioned at the first group header. Only line
+        prefixes are checked, records are not created."""
+        index = cls(reader.size)
+        transaction_type = None
+        while True:
+            line = reader.readline()
+            prefix = line[0:3]
+            if not line or prefix == 'TRL':
+                break
+            if prefix == 'GRH':
+                transaction_type = line[3:6]
+                index.group_headers.append(reader.line_position)
+                index.group_transactions.append(len(index.transactions))
+            elif prefix == 'GRT':
+                transaction_type = None
+                index.group_trailers.append(reader.line_position)
+            elif prefix == transaction_type:
+                index.transactions.append(reader.line_position)
+        if len(index.group_trailers) < len(index.group_headers):
+            index.group_trailers.append(reader.line_position)
+        return index
+
+    def __len__(self):
+        return len(self.transactions)
+
+    @property
+    def group_count(self):
+        return len(self.group_headers)
+
+    def get_group_number(self, n):
+        """Return the group (numbered from 1) of the n-th transaction."""
+        return bisect_right(self.group_transactions, n)
+
+    def get_transaction_span(self, n):
+        """Return the start and end offsets of the n-th transaction."""
+        if not 0 <= n < len(self.transactions):
+            raise IndexError(f'No transaction { n } in the index')
+        group = self.get_group_number(n)
+        start = self.transactions[n]
+        if n + 1 < len(self.transactions):
+            end = min(self.transactions[n + 1],
+                      self.group_trailers[group - 1])
+        else:
+            end = self.group_trailers[group - 1]
+        return start, end
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'size': self.size,
+            'fingerprint': self.fingerprint,
+            'group_headers': self.group_headers.tolist(),
+            'group_trailers': self.group_trailers.tolist(),
+            'group_transactions': self.group_transactions.tolist(),
+            'transactions': self.transactions.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != cls.version:
+            raise ValueError(f'Unsupported index version { d.get("version") }')
+        index = cls(d['size'], d['fingerprint'])
+        index.group_headers.extend(d['group_headers'])
+        index.group_trailers.extend(d['group_trailers'])
+        index.group_transactions.extend(d['group_transactions'])
+        index.transactions.extend(d['transactions'])
+        return index
+
+    def save(self, path):
+        """Save the index as a (JSON) sidecar file."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path):
+        """Load the index from a (JSON) sidecar file."""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,222 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains opt-in instrumentation of the parsing stages.
+
+When enabled, hot-path methods are replaced with timed wrappers, which are
+removed when disabled, so there is no overhead at all in normal use. Timings
+are inclusive, e.g. get_transactions includes split_into_records. Work done
+in worker processes (parallel mode) is not collected."""
+
+import contextlib
+import functools
+from collections import defaultdict
+from time import perf_counter
+
+from .fields import EdiField
+from .file import EdiFile, EdiGroup
+from .records import EdiRecord
+from .transactions import EdiTransaction
+
+
+class EdiStats(object):
+    """Counters and cumulative timings per stage and record type."""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def add(self, stage, elapsed, record_type=None):
+        key = (stage, record_type)
+        self.calls[key] += 1
+        self.seconds[key] += elapsed
+
+    def reset(self):
+        self.calls.clear()
+        self.seconds.clear()
+
+    def as_dict(self):
+        """Return the snapshot, totals per stage and per record type."""
+        stages = {}
+        record_types = {}
+        for (stage, record_type), calls in sorted(
+                self.calls.items(), key=lambda i: (i[0][0], i[0][1] or '')):
+            seconds = self.seconds[(stage, record_type)]
+            total = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+            total['calls'] += calls
+            total['seconds'] += seconds
+            if record_type is not None:
+                record_types.setdefault(stage, {})[record_type] = {
+                    'calls': calls, 'seconds': seconds}
+        return {'stages': stages, 'record_types': record_types}
+
+    def to_prometheus(self, prefix='edi'):
+        """Return the snapshot in Prometheus text exposition format."""
+        lines = []
+        for name, values in (
+                ('calls_total', self.calls), ('seconds_total', self.seconds)):
+            lines.append(f'# TYPE {prefix}_stage_{name} counter')
+            for (stage, record_type), value in sorted(
+                    values.items(), key=lambda i: (i[0][0], i[0][1] or '')):
+                record_type = (record_type or '').replace(
+                    '\\', '\\\\').replace('"', '\\"')
+                lines.append(
+                    f'{prefix}_stage_{name}{{stage="{stage}",'
+                    f'record_type="{record_type}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(function, stage, stats, key=None):
+    """Return the wrapper for a method, adding its duration to stats."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.add(stage, perf_counter() - start,
+                      key(*args) if key else None)
+    return wrapper
+
+
+def timed_once(function, stage, stats, key=None):
+    """Return the wrapper like timed, but calls within another call of the
+    same stage, e.g. through super(), are not added again."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if stage in _running:
+            return function(*args, **kwargs)
+        _running.add(stage)
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _running.discard(stage)
+            stats.add(stage, perf_counter() - start,
+                      key(*args) if key else None)
+    return wrapper
+
+
+def timed_generator(function, stage, stats, key=None):
+    """Return the wrapper for a generator method, adding time spent in the
+    generator for each item to stats."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        iterator = function(*args, **kwargs)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stats.add(stage, perf_counter() - start)
+                return
+            stats.add(stage, perf_counter() - start,
+                      key(item) if key else None)
+            yield item
+    return wrapper
+
+
+def record_type_of_record(record, *args):
+    if not record.line:
+        return None
+    record_type = record.line[0:3]
+    if isinstance(record_type, bytes):
+        return record_type.decode('latin1')
+    return record_type
+
+
+def record_type_of_argument(transaction, record, *args):
+    return record.type
+
+
+def record_type_of_item(record):
+    return record.type
+
+
+# (stage, class, method name, wrapper, key function)
+HOOKS = (
+    ('read_line', EdiFile, 'readline', timed, None),
+    ('get_transactions', EdiGroup, 'get_transactions', timed_generator,
+     None),
+    ('split_into_records', EdiTransaction, 'split_into_records',
+     timed_generator, record_type_of_item),
+    ('split_into_fields', EdiRecord, 'split_into_fields', timed,
+     record_type_of_record),
+    ('split_into_fields', EdiRecord, 'split_bytes_into_fields', timed,
+     record_type_of_record),
+    ('decode_field', EdiRecord, 'decode_field', timed,
+     record_type_of_record),
+    ('validate_record', EdiTransaction, 'validate_record', timed,
+     record_type_of_argument),
+    ('error_handling', EdiRecord, 'warning', timed_once,
+     record_type_of_record),
+    ('error_handling', EdiRecord, '_report', timed_once,
+     record_type_of_record),
+    ('error_handling', EdiRecord, '_materialize_errors', timed_once,
+     record_type_of_record),
+)
+
+
+def get_field_classes(cls=EdiField):
+    """Return the field class and its descendants (at any depth)."""
+    classes = [cls]
+    for c in classes:
+        classes.extend(
+            subclass for subclass in c.__subclasses__()
+            if subclass not in classes)
+    return classes
+
+
+def get_hooks():
+    """Return HOOKS, and conversion of values of all field classes,
+    defined at the time, see EdiField.decode."""
+    return HOOKS + tuple(
+        ('convert_field', cls, 'convert', timed_once, None)
+        for cls in get_field_classes() if 'convert' in cls.__dict__)
+
+
+_active = None
+_originals = []
+_running = set()  # stages in progress, see timed_once
+
+
+def enable(stats=None):
+    """Enable instrumentation, return the (new) EdiStats object."""
+    global _active
+    if _active is not None:
+        disable()
+    _active = stats or EdiStats()
+    for stage, cls, name, wrapper, key in get_hooks():
+        function = cls.__dict__[name]
+        _originals.append((cls, name, function))
+        setattr(cls, name, wrapper(function, stage, _active, key))
+    return _active
+
+
+def disable():
+    """Disable instrumentation, restoring original methods."""
+    global _active
+    while _originals:
+        cls, name, function = _originals.pop()
+        setattr(cls, name, function)
+    _active = None
+
+
+def get_stats():
+    """Return the active EdiStats object, None if disabled."""
+    return _active
+
+
+@contextlib.contextmanager
+def profiling(stats=None):
+    """Context manager, instrumentation is enabled within."""
+    stats = enable(stats)
+    try:
+        yield stats
+    finally:
+        disable()
@@ -0,0 +1,272 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains line readers."""
+
+import bz2
+import codecs
+import gzip
+import io
+import lzma
+import mmap
+import zipfile
+
+# Error handler for decoding data, bytes not valid in the encoding of the
+# file (e.g. a wrong character set in the header) are decoded as latin1
+DECODING_ERRORS = 'edi-latin1'
+
+
+def latin1_fallback(error):
+    """Decode bytes that failed decoding as latin1."""
+    return error.object[error.start:error.end].decode('latin1'), error.end
+
+
+codecs.register_error(DECODING_ERRORS, latin1_fallback)
+
+# Magic bytes of supported compression formats
+COMPRESSION_FORMATS = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'PK\x03\x04', 'zip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+
+
+def detect_compression(buffer):
+    """Return the compression format of a binary buffer, from magic bytes,
+    None if not compressed or not possible to tell."""
+    try:
+        if hasattr(buffer, 'peek'):
+            magic = buffer.peek(6)[:6]
+        else:
+            position = buffer.tell()
+            magic = buffer.read(6)
+            buffer.seek(position)
+    except (OSError, ValueError, AttributeError):
+        return None
+    if not isinstance(magic, bytes):
+        return None
+    for prefix, compression in COMPRESSION_FORMATS:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def open_compressed(buffer, compression, member=None):
+    """Return the binary stream decompressing data from the buffer.
+
+    For zip, member (name or ZipInfo) selects the file in the archive, it
+    can be omitted if there is only one."""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=buffer, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(buffer, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(buffer, mode='rb')
+    if compression == 'zip':
+        archive = zipfile.ZipFile(buffer)
+        if member is None:
+            members = [i for i in archive.infolist() if not i.is_dir()]
+            if len(members) != 1:
+                raise ValueError(
+                    'Select the file in the archive with member: {}'.format(
+                        ', '.join(i.filename for i in members)))
+            member = members[0]
+        return archive.open(member)
+    raise ValueError('Unsupported compression: {}'.format(compression))
+
+
+class EdiBytesReader(object):
+    """Line reader working on raw bytes, usually a memory-mapped file.
+
+    Line boundaries are found in the raw bytes, and only the line is
+    decoded, so there is no need for tell() and seek() on a text wrapper.
+    Both LF and CRLF line endings are supported."""
+
+    def __init__(self, data, position=0, encoding='latin1'):
+        self._data = data
+        self.size = len(data)
+        self.encoding = encoding
+        self.position = position
+        self.line_position = position
+
+    @classmethod
+    def from_buffer(cls, buffer, encoding='latin1'):
+        """Return the reader for a binary buffer, None if not possible."""
+        try:
+            position = buffer.tell()
+            if isinstance(buffer, io.BytesIO):
+                data = buffer.getvalue()
+            else:
+                data = mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, AttributeError):
+            return None
+        return cls(data, position, encoding)
+
+    def readline(self):
+        """Read the next line, without the line ending."""
+        return self.readline_bytes().decode(self.encoding, DECODING_ERRORS)
+
+    def readline_bytes(self):
+        """Read the next line as bytes, without the line ending."""
+        start = self.position
+        end = self._data.find(b'\n', start)
+        if end == -1:
+            end = self.size
+            self.position = end
+        else:
+            self.position = end + 1
+        if end > start and self._data[end - 1] == 13:  # CR
+            end -= 1
+        self.line_position = start
+        return self._data[start:end]
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        self.position = position
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+class EdiStreamReader(object):
+    """Line reader for a binary stream, usually decompressing data, read in
+    chunks of chunk_size bytes, so the data is never fully in memory.
+
+    Positions are in (decompressed) data. Seeking within the current chunk
+    is fast, otherwise the stream is seeked, which means decompressing
+    again from the start for backward seeks. Size is the size of the
+    source, i.e. compressed, if known."""
+
+    chunk_size = 1 << 20
+
+    def __init__(self, stream, encoding='latin1', size=None, position=0):
+        self._stream = stream
+        self.encoding = encoding
+        self.size = size
+        self._buffer = b''
+        self._start = position  # position of the buffer in data
+        self._offset = 0  # position in the buffer
+        self._eof = False
+        self.line_position = position
+
+    @classmethod
+    def from_buffer(cls, buffer, compression=None, encoding='latin1',
+                    member=None):
+        """Return the reader for a binary buffer, compressed or not."""
+        try:
+            position = buffer.tell()
+            size = buffer.seek(0, io.SEEK_END)
+            buffer.seek(position)
+        except (OSError, ValueError, AttributeError):
+            position = 0
+            size = None
+        if compression is None:
+            return cls(buffer, encoding, size, position)
+        return cls(open_compressed(buffer, compression, member), encoding,
+                   size)
+
+    def readline(self):
+        """Read the next line, without the line ending."""
+        return self.readline_bytes().decode(self.encoding, DECODING_ERRORS)
+
+    def readline_bytes(self):
+        """Read the next line as bytes, without the line ending."""
+        end = self._buffer.find(b'\n', self._offset)
+        while end == -1 and not self._eof:
+            chunk = self._stream.read(self.chunk_size)
+            if not chunk:
+                self._eof = True
+                break
+            # keep only the unread part
+            start = len(self._buffer) - self._offset
+            self._start += self._offset
+            self._buffer = self._buffer[self._offset:] + chunk
+            self._offset = 0
+            end = self._buffer.find(b'\n', start)
+        self.line_position = self._start + self._offset
+        if end == -1:
+            line = self._buffer[self._offset:]
+            self._offset = len(self._buffer)
+        else:
+            line = self._buffer[self._offset:end]
+            self._offset = end + 1
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line
+
+    def tell(self):
+        return self._start + self._offset
+
+    def seek(self, position):
+        if self._start <= position <= self._start + len(self._buffer):
+            self._offset = position - self._start
+            return
+        self._stream.seek(position)
+        self._buffer = b''
+        self._start = position
+        self._offset = 0
+        self._eof = False
+
+    def close(self):
+        self._stream.close()
+
+
+class EdiAsyncReader(object):
+    """Asynchronous line reader, for an asyncio.StreamReader (or anything
+    with a readline coroutine) or an asynchronous iterable of byte chunks,
+    e.g. the body of an HTTP request.
+
+    Lines are returned as soon as they are complete, so parsing can start
+    while data is still arriving."""
+
+    def __init__(self, stream, encoding='latin1'):
+        self.encoding = encoding
+        self.position = 0
+        if hasattr(stream, 'readline'):
+            self._stream = stream
+            self._chunks = None
+        else:
+            self._stream = None
+            self._chunks = stream.__aiter__()
+        self._buffer = b''
+        self._offset = 0
+        self._eof = False
+
+    async def _read_from_chunks(self):
+        """Return the next line from chunks, with the line ending."""
+        end = self._buffer.find(b'\n', self._offset)
+        while end == -1 and not self._eof:
+            try:
+                chunk = await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._eof = True
+                break
+            # keep only the unread part
+            start = len(self._buffer) - self._offset
+            self._buffer = self._buffer[self._offset:] + bytes(chunk)
+            self._offset = 0
+            end = self._buffer.find(b'\n', start)
+        if end == -1:
+            end = len(self._buffer) - 1
+        line = self._buffer[self._offset:end + 1]
+        self._offset = end + 1
+        return line
+
+    async def readline(self):
+        """Read the next line, without the line ending, '' at the end."""
+        if self._chunks is None:
+            line = await self._stream.readline()
+        else:
+            line = await self._read_from_chunks()
+        self.position += len(line)
+        if line.endswith(b'\n'):
+            line = line[:-1]
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        return line.decode(self.encoding, DECODING_ERRORS)
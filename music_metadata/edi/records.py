@@ -5,13 +5,100 @@ most notably Common Works Registration (CWR) and Common Royalty Distribution
 
 This file contains record definitions."""
 
+import codecs
 import collections
+import functools
+import struct
+from types import MappingProxyType
 
 from .fields import *
+from .reader import DECODING_ERRORS
+
+
+EdiFieldLayout = collections.namedtuple(
+    'EdiFieldLayout',
+    ('label', 'field', 'start', 'end', 'mandatory', 'decode'))
+
+
+def compile_layout(fields):
+    """Compile the layout plan for an ordered mapping of fields.
+
+    Returns a tuple of EdiFieldLayout entries with precomputed offsets and
+    the total specified length of the record.
+
+    Fields are decoded with EdiField.decode, returning error codes, unless
+    the field class overrides __set__, then it is used, raising errors."""
+    layout = []
+    pos = 0
+    for label, field in fields.items():
+        if type(field).__set__ is EdiField.__set__:
+            decode = field.decode
+        else:
+            decode = field.__set__
+        layout.append(EdiFieldLayout(
+            label, field, pos, pos + field._size, field._mandatory, decode))
+        pos += field._size
+    return tuple(layout), pos
+
+
+# How fields are decoded from bytes, see compile_bytes_layout
+BYTES_ASCII = 0
+BYTES_DEFERRED = 1
+BYTES_TEXT = 2
+
+
+def compile_bytes_layout(layout):
+    """Return the kind of bytes decoding for each entry of the layout.
+
+    Fields with ascii_only set are decoded from bytes (BYTES_ASCII).
+    Alphanumeric fields without own validation are only checked for
+    mandatory values, and decoded on first access (BYTES_DEFERRED). Other
+    fields are decoded to text first (BYTES_TEXT)."""
+    kinds = []
+    for entry in layout:
+        field = entry.field
+        if type(field).__set__ is not EdiField.__set__:
+            kinds.append(BYTES_TEXT)
+        elif field.ascii_only:
+            kinds.append(BYTES_ASCII)
+        elif type(field).convert is EdiField.convert:
+            kinds.append(BYTES_DEFERRED)
+        else:
+            kinds.append(BYTES_TEXT)
+    return tuple(kinds)
+
+
+def compile_struct(layout):
+    """Return struct.Struct splitting a full-length bytes line into field
+    values in one call, e.g. '3s8s8s' for three fields."""
+    return struct.Struct(''.join(
+        f'{ entry.end - entry.start }s' for entry in layout))
+
+
+@functools.lru_cache()
+def is_multibyte(encoding):
+    """Return True for encodings where characters may take several bytes,
+    so field positions in bytes and characters differ."""
+    return codecs.lookup(encoding).name.startswith('utf')
+
+
+def peek_number(record_class, line, label):
+    """Return the value of a numeric field from the line, as it would be set
+    by EdiNumericField, but without creating the record."""
+    value = record_class.peek(line, label)
+    try:
+        return int(value)
+    except ValueError:
+        return value or None
 
 
 class EdiRecordMeta(type):
-    """Meta class for EdiRecord"""
+    """Meta class for EdiRecord
+
+    Besides collecting fields, it compiles the layout plan (offsets, total
+    length, mandatory flags and decoders), so this arithmetic is not
+    repeated for every line, the index of each field in the compact value
+    storage of instances, and static parts of the HTML representation."""
 
     def __new__(mcs, name, bases, classdict):
         classdict['_fields'] = collections.OrderedDict()
@@ -21,26 +108,86 @@ class EdiRecordMeta(type):
         for label, field in classdict.items():
             if isinstance(field, EdiField):
                 classdict['_fields'][label] = field
+        classdict['_layout'], classdict['_length'] = compile_layout(
+            classdict['_fields'])
+        classdict['_index'] = dict(
+            (label, i) for i, label in enumerate(classdict['_fields']))
+        classdict['_bytes_layout'] = compile_bytes_layout(
+            classdict['_layout'])
+        classdict['_struct'] = compile_struct(classdict['_layout'])
+        classdict['_bytes_values'] = [
+            NOT_DECODED if kind == BYTES_DEFERRED else None
+            for kind in classdict['_bytes_layout']]
+        classdict['_html_template'] = tuple(
+            (label, field, field.get_html_template(label)
+             if type(field).to_html is EdiField.to_html else None)
+            for label, field in classdict['_fields'].items())
         return super().__new__(mcs, name, bases, classdict)
 
 
+NO_ERRORS = MappingProxyType(collections.OrderedDict())
+
+
 class EdiRecord(object, metaclass=EdiRecordMeta):
-    """Base class for all records."""
+    """Base class for all records.
+
+    Field values are kept in a list (indexed through _index), and the
+    error container is only allocated when the first error is recorded,
+    or when errors is read, get_errors reads them without allocating it.
+    Field errors are first recorded as compact error codes, exception
+    objects are only created when errors are read.
+    Instance dictionary is still available for subclasses, but is not
+    allocated unless used.
+
+    In lazy mode, only the line is kept, and each field is decoded and
+    validated on first access. Reading valid or errors, or calling
+    validate(), decodes all remaining fields.
+
+    The line can also be bytes, then it is decoded field by field, see
+    split_bytes_into_fields. Field positions are in characters, so a line
+    with multibyte characters is decoded as a whole."""
+
+    __slots__ = (
+        'sequence', 'line', 'rest', 'type', '_valid', '_values', '_errors',
+        '_codes', '_lazy', '_encoding', '__dict__', '__weakref__')
 
     record_type = EdiField(size=3, mandatory=True)
 
-    def __init__(self, line=None, sequence=None):
+    def __init__(self, line=None, sequence=None, lazy=False, encoding=None):
         super().__init__()
+        self._values = [None] * len(self._index)
+        self._errors = None
+        self._codes = None
+        self._lazy = False
+        self._encoding = None
         self.sequence = sequence
         self.line = line
         self.rest = ''
         self.type = None
         self.valid = True
-        self.errors = collections.OrderedDict()
         if self.line:
             if len(self.line) > 3:
-                self.split_into_fields()
+                if isinstance(line, bytes):
+                    encoding = encoding or 'latin1'
+                    if is_multibyte(encoding) and not line.isascii():
+                        line = self.line = line.decode(
+                            encoding, DECODING_ERRORS)
+                    else:
+                        self._encoding = encoding
+                if lazy:
+                    self._values = [NOT_DECODED] * len(self._index)
+                    self._lazy = True
+                    self.rest = line[self._length:]
+                    if self._encoding:
+                        self.rest = self.rest.decode(
+                            encoding, DECODING_ERRORS)
+                elif self._encoding:
+                    self.split_bytes_into_fields()
+                else:
+                    self.split_into_fields()
                 self.type = line[0:3]
+                if self._encoding:
+                    self.type = self.type.decode('latin1')
             else:
                 raise FileError(f'Record too short: {line}')
 
@@ -50,66 +197,230 @@ class EdiRecord(object, metaclass=EdiRecordMeta):
             self.type = key
 
     def to_edi(self):
-        output = ''
-        for label, field in self._fields.items():
-            value = getattr(self, label)
-            s = field.to_edi(value)
-            output += s
-        else:
-            output += self.rest
-        return output
+        output = [
+            field.to_edi(getattr(self, label))
+            for label, field in self._fields.items()]
+        output.append(self.rest)
+        return ''.join(output)
 
     def __str__(self):
         return self.to_edi()
 
+    @property
+    def valid(self):
+        if self._lazy:
+            self.decode_fields()
+        return self._valid
+
+    @valid.setter
+    def valid(self, value):
+        self._valid = value
+
+    @property
+    def errors(self):
+        """Errors by field label, the container is allocated if needed, so
+        errors can be added. Use get_errors only to read them."""
+        errors = self.get_errors()
+        if errors is NO_ERRORS:
+            errors = self._errors = collections.OrderedDict()
+        return errors
+
+    def get_errors(self):
+        """Return errors by field label, read-only NO_ERRORS if there are
+        none, without allocating the container."""
+        if self._lazy:
+            self.decode_fields()
+        if self._codes is not None:
+            self._materialize_errors()
+        if self._errors is None:
+            return NO_ERRORS
+        return self._errors
+
+    @errors.setter
+    def errors(self, value):
+        self._codes = None
+        self._errors = value
+
+    def _report(self, label, code, value=None):
+        """Record an error code for a field, invalidate unless it is a
+        warning. This is used instead of warning() and error() in decoding,
+        as no exception objects are created."""
+        if code not in WARNING_CODES:
+            self._valid = False
+        if self._codes is None:
+            self._codes = []
+        self._codes.append((label, code, value))
+
+    def _materialize_errors(self):
+        """Turn recorded error codes into exception objects."""
+        codes = self._codes
+        self._codes = None
+        if self._errors is None:
+            self._errors = collections.OrderedDict()
+        fields = self._fields
+        for label, code, value in codes:
+            self._errors[label] = fields[label].get_error(code, value)
+
     def warning(self, field, error):
         """Add an error, do not invalidate."""
+        if self._codes is not None:
+            # keep the order of errors
+            self._materialize_errors()
         if field and field not in self.labels:
             labels = ', '.join(self.labels)
             raise AttributeError(f'No such field { field } in { labels }')
-        self.errors[field] = error
+        if self._errors is None:
+            self._errors = collections.OrderedDict()
+        self._errors[field] = error
 
     def error(self, field, error):
         """Add an error and invalidate."""
-        self.valid = False
+        self._valid = False
         self.warning(field, error)
 
+    def _decode(self, i, line, actual_length):
+        """Decode and validate a single field in lazy mode.
+
+        This is the same as one step of split_into_fields, except that the
+        line is not extended, only the value."""
+        label, field, start, end, mandatory, decode = self._layout[i]
+        self._values[i] = None
+        value = line[start:end]
+        if (self._encoding is not None and
+                self._bytes_layout[i] != BYTES_ASCII):
+            value = value.decode(self._encoding, DECODING_ERRORS)
+        if end > actual_length:
+            value = value.ljust(end - start)
+            if start < actual_length:
+                self._report(label, ERROR_TRUNCATED)
+            elif mandatory:
+                self._report(label, ERROR_MANDATORY_MISSING)
+            else:
+                self._report(label, ERROR_MISSING_AT_END)
+        try:
+            error = decode(self, value)
+        except FieldWarning as e:
+            self.warning(label, e)
+        except FieldError as e:
+            self.error(label, e)
+        except (RecordError, FileError) as e:
+            self.error(label, e)
+        else:
+            if error is not None:
+                self._report(label, *error)
+
     def split_into_fields(self):
-        """Split a record into fields, extend with blanks if truncated."""
-        pos = 0
-        specified_length = 0
-        actual_length = len(self.line)
+        """Split a record into fields, extend with blanks if truncated.
+
+        Uses the layout plan compiled by EdiRecordMeta."""
+        line = self.line
+        actual_length = len(line)
 
         # Add blanks at the end if missing
-        for field in self.get_fields().values():
-            specified_length += field._size
-        if specified_length > actual_length:
-            self.line = self.line.ljust(specified_length)
+        if self._length > actual_length:
+            line = self.line = line.ljust(self._length)
+
+        for label, field, start, end, mandatory, decode in self._layout:
+            if end > actual_length:
+                if start < actual_length:
+                    self._report(label, ERROR_TRUNCATED)
+                elif mandatory:
+                    self._report(label, ERROR_MANDATORY_MISSING)
+                else:
+                    self._report(label, ERROR_MISSING_AT_END)
+            # fields overriding __set__ still raise errors
+            try:
+                error = decode(self, line[start:end])
+            except FieldWarning as e:
+                self.warning(label, e)
+            except FieldError as e:
+                self.error(label, e)
+            except (RecordError, FileError) as e:
+                self.error(label, e)
+            else:
+                if error is not None:
+                    self._report(label, *error)
 
-        for label, field in self.get_fields().items():
-            start = pos
-            end = pos + field._size
-            pos += field._size
-            value = self.line[start:end]
-            if start < actual_length < end:
-                self.warning(label, FieldWarning('Field truncated'))
-            elif end > actual_length:
-                if field._mandatory:
-                    self.error(label, RecordError('Mandatory field missing'))
+        self.rest = line[self._length:]
+
+    def split_bytes_into_fields(self):
+        """Split a bytes line into fields, extend with blanks if truncated.
+
+        Fields are split with one call of the struct compiled by
+        EdiRecordMeta. ASCII-only fields (numeric, list, flag, constant)
+        are decoded without decoding text. Alphanumeric fields are only
+        checked for mandatory values here, and decoded when accessed."""
+        line = self.line
+        actual_length = len(line)
+        encoding = self._encoding
+        self._values = list(self._bytes_values)
+
+        # Add blanks at the end if missing
+        truncated = self._length > actual_length
+        if truncated:
+            line = self.line = line.ljust(self._length)
+
+        for (label, field, start, end, mandatory, decode), kind, value in zip(
+                self._layout, self._bytes_layout,
+                self._struct.unpack_from(line)):
+            if truncated and end > actual_length:
+                if start < actual_length:
+                    self._report(label, ERROR_TRUNCATED)
+                elif mandatory:
+                    self._report(label, ERROR_MANDATORY_MISSING)
                 else:
-                    self.warning(label, FieldWarning(
-                        'Field missing at the end of the line.'))
+                    self._report(label, ERROR_MISSING_AT_END)
+            if kind == BYTES_DEFERRED:
+                if not value.strip():
+                    field._store(self, None)
+                    if mandatory:
+                        self._report(label, ERROR_MANDATORY)
+                continue
+            if kind == BYTES_TEXT:
+                value = value.decode(encoding, DECODING_ERRORS)
+            # fields overriding __set__ still raise errors
             try:
-                setattr(self, label, value)
+                error = decode(self, value)
             except FieldWarning as e:
                 self.warning(label, e)
             except FieldError as e:
                 self.error(label, e)
             except (RecordError, FileError) as e:
                 self.error(label, e)
+            else:
+                if error is not None:
+                    self._report(label, *error)
+
+        self.rest = line[self._length:].decode(encoding, DECODING_ERRORS)
+
+    def decode_field(self, label):
+        """Decode a single field in lazy mode and return the value."""
+        i = self._index[label]
+        self._decode(i, self.line, len(self.line))
+        return self._values[i]
+
+    def decode_fields(self):
+        """Decode all fields not decoded yet, ending the lazy mode."""
+        if not self._lazy:
+            return
+        self._lazy = False
+        line = self.line
+        actual_length = len(line)
+        values = self._values
+        for i, value in enumerate(values):
+            if value is NOT_DECODED:
+                self._decode(i, line, actual_length)
 
-        else:
-            self.rest = self.line[pos:]
+    def validate(self):
+        """Force full decoding and validation of all fields."""
+        self.decode_fields()
+
+    @classmethod
+    def peek(cls, line, label):
+        """Return the stripped value of a field from the line, without
+        creating the record or validating the value."""
+        layout = cls._layout[cls._index[label]]
+        return line[layout.start:layout.end].strip()
 
     def get_fields(self):
         return self._fields
@@ -126,17 +437,20 @@ class EdiRecord(object, metaclass=EdiRecordMeta):
         classes = f'record { self.type.lower() }'
         if not self.valid:
             classes += ' invalid'
-        output = f'<span class="{ classes }">'
-        for field in self.fields:
-            value = getattr(self, field._name)
-            s = field.to_html(
-                value, f'{ field._name }', self.errors.get(field._name))
-            output += s
-        else:
-            output += EdiField.to_html(
-                None, self.rest, label='', error=self.errors.get(None))
-        output += '</span>'
-        return output
+        errors = self.get_errors()
+        output = [f'<span class="{ classes }">']
+        for label, field, template in self._html_template:
+            value = getattr(self, label)
+            if template is None:
+                output.append(field.to_html(value, label, errors.get(label)))
+            else:
+                output.append(render_html(
+                    template, field.to_edi(value), field.verbose(value),
+                    errors.get(label)))
+        output.append(render_html(
+            REST_HTML_TEMPLATE, self.rest, self.rest, errors.get(None)))
+        output.append('</span>')
+        return ''.join(output)
 
     def to_dict(self, verbosity=1):
         return {'error': 'Not implemented for this record type.'}
@@ -167,7 +481,7 @@ class EdiTransactionRecord(EdiRecord):
 
     def validate(self):
         """Validate the record, needed for subclasses."""
-        pass
+        super().validate()
 
     def to_dict(self, verbosity=1):
         d = OrderedDict()
@@ -178,7 +492,7 @@ class EdiTransactionRecord(EdiRecord):
                 'record_type',
                 'transaction_sequence_number',
                 'record_sequence_number'
-            ] and label not in self.errors.keys():
+            ] and label not in self.get_errors():
                 continue
 
             # constant fields can be skipper as well
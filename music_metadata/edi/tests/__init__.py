@@ -1,15 +1,89 @@
+import asyncio
+import bz2
+import gc
+import gzip
+import io
+import json
+import lzma
 import os
+import tempfile
+import tracemalloc
 import unittest
+import weakref
+import zipfile
 
+from music_metadata.edi import cli, instrumentation
+from music_metadata.edi.cache import EdiTransactionCache
+from music_metadata.edi import columns as columns_module
+from music_metadata.edi.columns import (
+    MISSING, lines_to_columns, numpy, to_columns)
+from music_metadata.edi.fields import NOT_DECODED
 from music_metadata.edi.file import EdiFile, EdiGroup
+from music_metadata.edi.reader import EdiBytesReader, EdiStreamReader
 from music_metadata.edi.records import *
 from music_metadata.edi.transactions import EdiTransaction
+from music_metadata.edi.writer import EdiWriter
 
 FOLDER_PATH = os.path.dirname(os.path.realpath(__file__))
 CWR2_PATH = os.path.join(FOLDER_PATH, 'CW190001MPC_000.V21')
 CWR3_PATH = os.path.join(FOLDER_PATH, 'CW190008MPC_0000_V3-0-0.ISR')
 
 
+# A minimal format with a character set in the header, at module level, so
+# transactions can be pickled (workers and the transaction cache)
+class TitleHeader(EdiHDR):
+    record_type = EdiConstantField(size=3, constant='HDR', mandatory=True)
+    character_set = EdiField(size=15)
+
+
+class TitleRecord(EdiTransactionRecord):
+    title = EdiField(size=10, mandatory=True)
+    duration = EdiNumericField(size=4)
+
+
+class TitleTransaction(EdiTransaction):
+    record_type = 'NWR'
+    record_classes = {'NWR': TitleRecord}
+
+
+class TitleGroup(EdiGroup):
+    transaction_classes = [TitleTransaction]
+
+
+class TitleFile(EdiFile):
+    header_class = TitleHeader
+    group_class = TitleGroup
+
+
+def summarize_file(e, details=False, **kwargs):
+    """Parse the file, return transactions, groups and the file summary,
+    to compare results of parsing modes. Keyword arguments are passed to
+    get_groups.
+
+    Transactions are summarized with their records as EDI, with details
+    also with errors of transactions, and records with validity, values
+    and errors."""
+    transactions = []
+    groups = []
+    for group in e.get_groups(**kwargs):
+        for t in group.get_transactions():
+            if details:
+                transactions.append((
+                    str(t), t.valid, [str(err) for err in t.errors],
+                    [(r.type, r.valid, r.to_edi(), r.to_dict(),
+                      [(k, str(v)) for k, v in r.errors.items()])
+                     for r in t.records]))
+            else:
+                transactions.append(
+                    (str(t), t.valid, [r.to_edi() for r in t.records]))
+        groups.append((
+            group.valid, group.transaction_count, group.record_count,
+            [str(err) for err in group.errors]))
+    return transactions, groups, (
+        e.valid, e.transaction_count, e.record_count,
+        [str(err) for err in e.file_errors])
+
+
 class TestEdi(unittest.TestCase):
 
     def test_edifield(self):
@@ -140,6 +214,991 @@ class TestEdi(unittest.TestCase):
         with self.assertRaises(AttributeError):
             record.warning('rest', FieldWarning('test'))
 
+    def test_layout(self):
+        self.assertEqual(EdiGRT._length, 24)
+        self.assertEqual(
+            [(l.label, l.start, l.end, l.mandatory) for l in EdiGRT._layout],
+            [('record_type', 0, 3, True), ('group_code', 3, 8, True),
+             ('transaction_count', 8, 16, True),
+             ('record_count', 16, 24, True)])
+        record = EdiGRT('GRT000010000000100000003EXTRA')
+        self.assertEqual(record.transaction_count, 1)
+        self.assertEqual(record.record_count, 3)
+        self.assertEqual(record.rest, 'EXTRA')
+        self.assertEqual(EdiGRT._struct.format, '3s5s8s8s')
+        self.assertEqual(EdiGRT._struct.size, EdiGRT._length)
+        # bytes are split with the struct, also truncated lines
+        for line in (b'GRT000010000000100000003EXTRA', b'GRT0000100000'):
+            results = [
+                (record.group_code, record.transaction_count, record.rest,
+                 record.valid,
+                 [(k, str(v)) for k, v in record.errors.items()])
+                for record in (
+                    EdiGRT(line, encoding='ascii'), EdiGRT(line.decode()))]
+            self.assertEqual(results[0], results[1])
+
+    def test_compact_storage(self):
+        record = EdiGRT('GRT000010000000100000003')
+        self.assertEqual(record._values, ['GRT', 1, 1, 3])
+        self.assertIsNone(record._errors)
+        self.assertEqual(dict(record.get_errors()), {})
+        self.assertIsNone(record._errors)
+        record.errors['record_count'] = FieldError('testing')
+        self.assertIn('record_count', record.get_errors())
+        record.errors = None
+        record.record_count = 4
+        self.assertEqual(record.record_count, 4)
+        record.error('record_count', FieldError('testing'))
+        self.assertFalse(record.valid)
+        self.assertIn('record_count', record.errors)
+
+    def test_error_codes(self):
+
+        class LegacyField(EdiField):
+            def __set__(self, instance, value):
+                self._store(instance, value)
+                raise FieldWarning('Legacy')
+
+        class Record(EdiTransactionRecord):
+            num = EdiNumericField(size=4)
+            role = EdiListField(size=2, choices=(('CA', 'Composer/Author'),))
+            txt = EdiField(size=4, mandatory=True)
+
+        class LegacyRecord(Record):
+            legacy = LegacyField(size=2)
+
+        record = Record('ABC0000000000000001X001XX')
+        self.assertFalse(record.valid)
+        self.assertIsNone(record._errors)
+        # txt is both missing and mandatory, the latter overrides
+        self.assertEqual(
+            [c[0] for c in record._codes], ['num', 'role', 'txt', 'txt'])
+        self.assertEqual(
+            [(label, type(e), str(e)) for label, e in record.errors.items()],
+            [('num', RecordError, 'Value "X001" is not numeric'),
+             ('role', FieldError, 'Value must be one of "CA"'),
+             ('txt', FieldError, 'Value is mandatory')])
+        self.assertIsNone(record._codes)
+        with self.assertRaises(FieldError):
+            record.role = 'XX'
+        record = Record('ABC0000000000000001000')
+        self.assertEqual(str(record.errors['num']), 'Field truncated')
+        record = LegacyRecord('ABC0000000000000001X001XXTEXTAB')
+        self.assertEqual(record.legacy, 'AB')
+        self.assertEqual(list(record.errors), ['num', 'role', 'legacy'])
+
+    def test_decode_cache(self):
+
+        class Record(EdiTransactionRecord):
+            role = EdiListField(size=2, choices=(('CA', 'Composer/Author'),))
+            society = EdiNumericField(size=3)
+            title = EdiField(size=10)
+            code = EdiField(size=2, cache=False)
+            flag = EdiFlagField()
+
+        fields = Record._fields
+        self.assertIsNone(fields['title']._decode_cache)
+        self.assertIsNone(fields['code']._decode_cache)
+        r1 = Record('ABC0000000000000000CA052TITLE     ABY')
+        r2 = Record('ABC0000000100000000CA052TITLE     ABN')
+        self.assertIs(r1.role, r2.role)
+        self.assertEqual(r1.society, 52)
+        self.assertEqual(fields['role']._decode_cache['CA'], ('CA', None))
+        self.assertEqual((r1.flag, r2.flag), (True, False))
+        self.assertEqual(r1.to_edi()[-1], 'Y')
+
+        # errors are cached as well
+        r1 = Record('ABC0000000000000000XXX52')
+        r2 = Record('ABC0000000000000000XXX52')
+        self.assertEqual(list(r1.errors), ['role', 'society', 'title', 'code',
+                                           'flag'])
+        self.assertEqual(str(r2.errors['society']),
+                         'Value "X52" is not numeric')
+        self.assertEqual(r2.society, 'X52')
+
+        # size is limited
+        field = fields['society']
+        field.decode_cache_size = len(field._decode_cache) + 1
+        for i in range(10):
+            Record(f'ABC0000000000000000CA{i:03d}')
+        self.assertEqual(len(field._decode_cache), field.decode_cache_size)
+        self.assertEqual(Record('ABC0000000000000000CA009').society, 9)
+
+    def test_lazy_record(self):
+
+        class Record(EdiTransactionRecord):
+            num = EdiNumericField(size=4, mandatory=True)
+            txt = EdiField(size=4, mandatory=True)
+
+        record = Record('ABC0000000000000001X001', lazy=True)
+        self.assertEqual(record.type, 'ABC')
+        self.assertIs(record._values[0], NOT_DECODED)
+        self.assertEqual(record.record_sequence_number, 1)
+        self.assertIs(record._values[3], NOT_DECODED)
+        self.assertEqual(record.num, 'X001')
+        self.assertIs(record._values[4], NOT_DECODED)
+        self.assertFalse(record.valid)
+        self.assertIn('num', record.errors)
+        self.assertIn('txt', record.errors)
+        self.assertEqual(record.to_edi(), 'ABC0000000000000001X001    ')
+
+        record = Record('ABC00000000000000010001TEXT', lazy=True)
+        record.validate()
+        self.assertEqual(record._values, ['ABC', 0, 1, 1, 'TEXT'])
+        self.assertTrue(record.valid)
+
+    def test_lazy_file(self):
+        with open(CWR2_PATH, 'rb') as f:
+            expected = []
+            for group in EdiFile(f).get_groups():
+                for transaction in group.get_transactions():
+                    expected.append((
+                        transaction.valid, [
+                            (r.valid, r.to_edi(), list(r.errors))
+                            for r in transaction.records]))
+        with open(CWR2_PATH, 'rb') as f:
+            result = []
+            e = EdiFile(f, lazy=True)
+            for group in e.get_groups():
+                for transaction in group.get_transactions():
+                    self.assertEqual(transaction.records[0].record_type, 'NWR')
+                    result.append((
+                        transaction.valid, [
+                            (r.valid, r.to_edi(), list(r.errors))
+                            for r in transaction.records]))
+        self.assertEqual(result, expected)
+
+    def test_readers(self):
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f)
+            self.assertIsInstance(e._reader, EdiBytesReader)
+            expected = summarize_file(e)
+            e.close()
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f, use_mmap=False)
+            self.assertIsNone(e._reader)
+            self.assertEqual(summarize_file(e), expected)
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read().replace(b'\n', b'\r\n')
+        e = EdiFile(io.BytesIO(data))
+        self.assertFalse(e.header_line.endswith('\r'))
+        self.assertEqual(summarize_file(e), expected)
+        self.assertTrue(e.trailer_line.startswith('TRL'))
+        self.assertFalse(e.trailer_line.endswith('\r'))
+
+    def test_cli(self):
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as root:
+            folder = os.path.join(root, 'files')
+            os.makedirs(os.path.join(folder, 'sub'))
+            for name, content in (
+                    ('a.V21', data), ('sub/b.V21.gz', gzip.compress(data)),
+                    ('c.V21', b'not an EDI file')):
+                with open(os.path.join(folder, name), 'wb') as f:
+                    f.write(content)
+            output = os.path.join(root, 'report.json')
+            for workers in ('0', '2'):
+                cli.main([folder, CWR3_PATH, '--recursive', '--workers',
+                          workers, '--output', output])
+                with open(output) as f:
+                    report = json.load(f)
+                self.assertEqual(
+                    [os.path.basename(r['path']) for r in report['files']],
+                    ['CW190008MPC_0000_V3-0-0.ISR', 'a.V21', 'c.V21',
+                     'b.V21.gz'])
+                cwr3, a, c, b = report['files']
+                self.assertEqual(cwr3['file_errors'],
+                                 ['File trailer missing'])
+                self.assertEqual(a['file_errors'], b['file_errors'])
+                self.assertFalse(a['valid'])
+                self.assertEqual(a['group_count'], 1)
+                self.assertEqual(a['transaction_count'], 100)
+                self.assertFalse(c['valid'])
+                self.assertTrue(c['file_errors'])
+                self.assertEqual(report['summary']['files'], 4)
+                self.assertEqual(report['summary']['invalid'], 4)
+                self.assertEqual(
+                    report['summary']['transaction_count'],
+                    200 + cwr3['transaction_count'])
+            self.assertEqual(
+                cli.find_files([os.path.join(folder, '*.V21')]),
+                [os.path.join(folder, 'a.V21'),
+                 os.path.join(folder, 'c.V21')])
+
+    def test_compressed(self):
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        e = EdiFile(io.BytesIO(data))
+        structure_errors = [str(err) for err in e.validate_structure()]
+        expected = summarize_file(e)
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('CW190001MPC_000.V21', data)
+        for compressed in (
+                gzip.compress(data), bz2.compress(data), lzma.compress(data),
+                archive.getvalue()):
+            e = EdiFile(io.BytesIO(compressed))
+            self.assertIsInstance(e._reader, EdiStreamReader)
+            self.assertEqual(summarize_file(e), expected)
+            e = EdiFile(io.BytesIO(compressed), bytes_mode=True)
+            self.assertEqual(summarize_file(e), expected)
+
+        # chunk boundaries within lines, structure validation, index
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'CW190001MPC_000.V21.gz')
+            with open(path, 'wb') as f:
+                f.write(gzip.compress(data.replace(b'\n', b'\r\n')))
+            with open(path, 'rb') as f:
+                e = EdiFile(f)
+                e._reader.chunk_size = 100
+                self.assertEqual(
+                    [str(err) for err in e.validate_structure()],
+                    structure_errors)
+                self.assertEqual(summarize_file(e), expected)
+                self.assertEqual(
+                    [r.to_edi() for r in e.transaction_at(3).records],
+                    expected[0][3][2])
+
+        # members in zip archives
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('README', 'Not EDI.')
+            z.writestr('CW190001MPC_000.V21', data)
+        with self.assertRaises(ValueError):
+            EdiFile(io.BytesIO(archive.getvalue()))
+        e = EdiFile(io.BytesIO(archive.getvalue()),
+                    member='CW190001MPC_000.V21')
+        self.assertEqual(summarize_file(e), expected)
+
+    def test_parallel(self):
+        with open(CWR2_PATH, 'rb') as f:
+            expected = summarize_file(EdiFile(f), details=True)
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f, workers=2)
+            e.batch_size = 7
+            self.assertEqual(summarize_file(e, details=True), expected)
+            e.close()
+            self.assertIsNone(e._executor)
+
+    def test_async(self):
+        def summary(e, transactions, groups):
+            return (
+                transactions, groups, e.valid, e.transaction_count,
+                e.record_count, [str(err) for err in e.file_errors])
+
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        e = EdiFile(io.BytesIO(data))
+        transactions = []
+        groups = []
+        for group in e.get_groups():
+            transactions.extend(
+                (str(t), t.valid, [r.to_edi() for r in t.records])
+                for t in group.get_transactions())
+            groups.append((group.valid, [str(err) for err in group.errors]))
+        expected = summary(e, transactions, groups)
+
+        async def chunks():
+            for i in range(0, len(data), 1000):
+                await asyncio.sleep(0)
+                yield data[i:i + 1000]
+
+        async def parse(stream):
+            e = await EdiFile.from_stream(stream)
+            self.assertEqual(type(e).__name__, 'EdiFile')
+            transactions = []
+            groups = []
+            async for group in e:
+                async for t in group:
+                    transactions.append(
+                        (str(t), t.valid, [r.to_edi() for r in t.records]))
+                groups.append(
+                    (group.valid, [str(err) for err in group.errors]))
+            return summary(e, transactions, groups)
+
+        async def parse_stream_reader():
+            stream = asyncio.StreamReader()
+            stream.feed_data(data)
+            stream.feed_eof()
+            return await parse(stream)
+
+        self.assertEqual(asyncio.run(parse(chunks())), expected)
+        self.assertEqual(asyncio.run(parse_stream_reader()), expected)
+
+    def test_checkpoint(self):
+        def parse(e, groups):
+            result = []
+            for group in groups:
+                for transaction in group.get_transactions():
+                    result.append((
+                        group.sequence, str(transaction), transaction.valid,
+                        [r.to_edi() for r in transaction.records]))
+                    yield result
+                result.append((
+                    group.sequence, group.valid,
+                    [str(err) for err in group.errors]))
+                yield result
+            result.append((
+                e.valid, e.transaction_count, e.record_count,
+                [str(err) for err in e.file_errors]))
+            yield result
+
+        # three groups, the first one with a wrong record count
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f)
+            transactions = [
+                t for group in e.get_groups()
+                for t in group.get_transactions()]
+        output = io.BytesIO()
+        writer = EdiWriter(output, e.header())
+        for i in range(0, len(transactions), 40):
+            writer.write_group('NWR', transactions[i:i + 40])
+        writer.close()
+        data = output.getvalue().replace(
+            b'GRT000010000004000000', b'GRT000010000004000009', 1)
+
+        e = EdiFile(io.BytesIO(data))
+        expected = list(parse(e, e.get_groups()))[-1]
+        self.assertIn(
+            (1, False, ['Wrong record count in GRT: 9629, counted 629']),
+            expected)
+        self.assertEqual(len(expected), 104)
+
+        def resume(data, expected, n):
+            e = EdiFile(io.BytesIO(data))
+            steps = parse(e, e.get_groups())
+            if n:
+                for i in range(n):
+                    result = next(steps)
+                result = list(result)
+            else:
+                result = []
+            checkpoint = json.loads(json.dumps(e.checkpoint()))
+            e = EdiFile(io.BytesIO(data))
+            groups = e.get_groups(checkpoint=checkpoint)
+            result.extend(list(parse(e, groups))[-1])
+            self.assertEqual(result, expected)
+            return checkpoint
+
+        for n in (0, 1, 39, 40, 41, 42, 80, len(expected) - 1):
+            checkpoint = resume(data, expected, n)
+        with self.assertRaises(ValueError):
+            e = EdiFile(io.BytesIO(data + b'\n'))
+            list(e.get_groups(checkpoint=checkpoint))
+
+        # file errors of the last transaction, checked with the trailer
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        e = EdiFile(io.BytesIO(data))
+        expected = list(parse(e, e.get_groups()))[-1]
+        self.assertIn(
+            'Wrong transaction sequence 199, should be 99', expected[-1][-1])
+        for n in (99, 100):
+            resume(data, expected, n)
+
+    def test_cache(self):
+        def parse(data, cache=None):
+            return summarize_file(
+                EdiFile(io.BytesIO(data), cache=cache), details=True)
+
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        # same transactions, but with sequences from 0 in each group
+        e = EdiFile(io.BytesIO(data))
+        output = io.BytesIO()
+        with EdiWriter(output, e.header()) as writer:
+            for group in e.get_groups():
+                transactions = list(group.get_transactions())
+                writer.write_group('NWR', transactions[:50])
+                writer.write_group('NWR', transactions[50:])
+        resent = output.getvalue()
+
+        with tempfile.TemporaryDirectory() as folder:
+            cache = EdiTransactionCache(maxsize=1000, path=folder)
+            self.assertEqual(parse(data, cache), parse(data))
+            self.assertEqual(cache.hits, 0)
+            cached = len(cache)
+            self.assertTrue(50 < cached < 100)
+            self.assertEqual(parse(data, cache), parse(data))
+            self.assertEqual(cache.hits, cached)
+            self.assertEqual(parse(resent, cache), parse(resent))
+
+            # all transactions in resent are cached, on disk as well
+            cache = EdiTransactionCache(maxsize=10, path=folder)
+            self.assertEqual(parse(resent, cache), parse(resent))
+            self.assertEqual(len(cache), 10)
+            self.assertEqual((cache.hits, cache.misses), (100, 0))
+
+    def test_bytes_mode(self):
+        for path in (CWR2_PATH, CWR3_PATH):
+            with open(path, 'rb') as f:
+                data = f.read()
+            expected = summarize_file(EdiFile(io.BytesIO(data)), details=True)
+            e = EdiFile(io.BytesIO(data), bytes_mode=True)
+            self.assertIsInstance(e.header_line, str)
+            self.assertEqual(summarize_file(e, details=True), expected)
+            # records with deferred fields are pickled
+            e = EdiFile(io.BytesIO(data), bytes_mode=True, workers=2)
+            self.assertEqual(summarize_file(e, details=True), expected)
+            e.close()
+            cache = EdiTransactionCache()
+            for i in range(2):
+                e = EdiFile(io.BytesIO(data), bytes_mode=True, cache=cache)
+                self.assertEqual(summarize_file(e, details=True), expected)
+            self.assertTrue(cache.hits)
+        with self.assertRaises(ValueError):
+            with open(CWR2_PATH, 'rb') as f:
+                EdiFile(f, use_mmap=False, bytes_mode=True)
+
+        def parse(data, **kwargs):
+            e = TitleFile(io.BytesIO(data), **kwargs)
+            records = [
+                r for group in e.get_groups()
+                for transaction in group.get_transactions()
+                for r in transaction.records]
+            return e.data_encoding, [(r.title, r.duration) for r in records]
+
+        lines = [
+            'HDR{:15}', 'GRHNWR00001', 'NWR0000000000000000CAFÉ      0123',
+            'NWR0000000100000000ÉTÉ       0100', 'GRT000010000000200000004',
+            'TRL000010000000200000006', '']
+        expected = [('CAFÉ', 123), ('ÉTÉ', 100)]
+        async def parse_stream(data):
+            stream = asyncio.StreamReader()
+            stream.feed_data(data)
+            stream.feed_eof()
+            e = await TitleFile.from_stream(stream)
+            records = []
+            async for group in e:
+                async for transaction in group:
+                    records.extend(transaction.records)
+            return e.data_encoding, [(r.title, r.duration) for r in records]
+
+        # wrong character set, bytes not valid in it are decoded as latin1
+        for character_set, encoding, data_encoding in (
+                ('UTF-8', 'utf-8', 'utf-8'), ('', 'latin1', 'latin1'),
+                ('UNKNOWN', 'latin1', 'latin1'),
+                ('ASCII', 'latin1', 'ascii'), ('UTF-8', 'latin1', 'utf-8')):
+            data = '\n'.join(lines).format(character_set).encode(encoding)
+            for kwargs in ({}, {'bytes_mode': True}, {'use_mmap': False}):
+                self.assertEqual(
+                    parse(data, **kwargs), (data_encoding, expected))
+            self.assertEqual(
+                asyncio.run(parse_stream(data)), (data_encoding, expected))
+        # cached transactions, also with multibyte characters, are only
+        # reused with the same encoding
+        cache = EdiTransactionCache()
+        for character_set in ('UTF-8', 'UTF-8', '', ''):
+            data = '\n'.join(lines).format(character_set).encode('utf-8')
+            self.assertEqual(
+                parse(data, bytes_mode=True, cache=cache), parse(data))
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+        # Whole lines with multibyte characters are decoded, others are not
+        data = '\n'.join(lines).format('UTF-8').encode('utf-8')
+        e = TitleFile(io.BytesIO(data), bytes_mode=True)
+        for group in e.get_groups():
+            for transaction in group.get_transactions():
+                self.assertIsInstance(transaction.records[0].line, str)
+        data = '\n'.join(lines).format('').encode('latin1')
+        e = TitleFile(io.BytesIO(data), bytes_mode=True)
+        records = [
+            r for group in e.get_groups()
+            for transaction in group.get_transactions()
+            for r in transaction.records]
+        for record, (title, duration) in zip(records, expected):
+            self.assertIsInstance(record.line, bytes)
+            self.assertIs(record._values[3], NOT_DECODED)
+            self.assertEqual(record.duration, duration)
+            self.assertTrue(record.valid)
+            self.assertIs(record._values[3], NOT_DECODED)
+            self.assertEqual(record.title, title)
+
+    def test_streaming(self):
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        # groups keep the file, except in streaming mode
+        group = next(EdiFile(io.BytesIO(data)).get_groups())
+        self.assertEqual(len(list(group.get_transactions())), 100)
+        e = EdiFile(io.BytesIO(data), streaming=True)
+        groups = e.get_groups()
+        group = next(groups)
+        self.assertIs(group.file(), e)
+        reference = weakref.ref(e)
+        groups.close()
+        del e, groups
+        # no reference cycles, freed without garbage collection
+        self.assertIsNone(reference())
+        self.assertIsNone(group.file())
+        with self.assertRaises(RuntimeError):
+            next(group.get_transactions())
+
+        # errors over max_errors go to the sink
+        e = EdiFile(io.BytesIO(data))
+        expected = []
+        for group in e.get_groups():
+            expected.extend(str(t) for t in group.get_transactions())
+        group_errors = [str(err) for err in group.errors]
+        file_errors = [str(err) for err in e.file_errors]
+        self.assertTrue(file_errors)
+        sink = []
+        e = EdiFile(io.BytesIO(data), streaming=True, max_errors=1,
+                    error_sink=lambda error, context: sink.append(
+                        (str(error), context)))
+        self.assertIsInstance(e._reader, EdiStreamReader)
+        transactions = [
+            t for g in e.get_groups() for t in g.get_transactions()]
+        self.assertEqual([str(t) for t in transactions], expected)
+        self.assertTrue(all(t.records == [] for t in transactions))
+        self.assertEqual([str(err) for err in e.file_errors],
+                         file_errors[:1])
+        self.assertEqual(e.file_errors.overflow, len(file_errors) - 1)
+        self.assertEqual(
+            [err for err, context in sink if context == 'file'],
+            file_errors[1:])
+        self.assertEqual(
+            [(err, context) for err, context in sink if context != 'file'],
+            [(err, 'group 1') for err in group_errors[1:]])
+
+        # memory does not depend on the file size
+        transactions = [
+            t for g in EdiFile(io.BytesIO(data)).get_groups()
+            for t in g.get_transactions()]
+        peaks = []
+        for n, traced in ((10, False), (2, True), (8, True)):
+            # the first run fills (bounded) decoding caches
+            output = io.BytesIO()
+            writer = EdiWriter(output, e.header())
+            for i in range(n):
+                writer.write_group('NWR', transactions)
+            writer.close()
+            e = EdiFile(io.BytesIO(output.getvalue()), streaming=True)
+            e._reader.chunk_size = 1 << 14
+            if traced:
+                tracemalloc.start()
+            try:
+                for group in e.get_groups():
+                    for transaction in group.get_transactions():
+                        pass
+                if traced:
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(e.transaction_count, n * 100)
+        # up to three chunks in memory while the buffer is extended
+        self.assertLess(peaks[1], peaks[0] + 3 * e._reader.chunk_size)
+
+    def test_filters(self):
+        with open(CWR2_PATH, 'rb') as f:
+            data = f.read()
+        transactions, groups, expected = summarize_file(
+            EdiFile(io.BytesIO(data)))
+        record_types = {'NWR', 'SPU', 'SWR'}
+        filtered = [
+            (t, valid, [line for line in lines if line[0:3] in record_types])
+            for t, valid, lines in transactions]
+        for kwargs in ({}, {'bytes_mode': True}, {'workers': 2}):
+            e = EdiFile(io.BytesIO(data), **kwargs)
+            self.assertEqual(
+                summarize_file(e, record_types=record_types),
+                (filtered, groups, expected))
+        e = EdiFile(io.BytesIO(data))
+        self.assertEqual(
+            summarize_file(e, group_types=['REV']), ([], [], expected))
+        e = EdiFile(io.BytesIO(data))
+        self.assertEqual(
+            summarize_file(e, transaction_types=['REV']),
+            ([], groups, expected))
+        e = EdiFile(io.BytesIO(data))
+        self.assertEqual(
+            summarize_file(e, group_types=['NWR'], transaction_types=['NWR']),
+            (transactions, groups, expected))
+
+        # arguments of get_transactions override defaults
+        e = EdiFile(io.BytesIO(data))
+        for group in e.get_groups(record_types={'NWR'}):
+            transaction = next(group.get_transactions(record_types={'SPU'}))
+            self.assertEqual(
+                [r.to_edi() for r in transaction.records],
+                [line for line in transactions[0][2] if line[0:3] == 'SPU'])
+
+    def test_index(self):
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f)
+            expected = []
+            for group in e.get_groups():
+                expected.extend(
+                    (str(t), t.valid, [r.to_edi() for r in t.records])
+                    for t in group.get_transactions())
+                group_errors = [str(err) for err in group.errors]
+        with tempfile.TemporaryDirectory() as folder:
+            sidecar = os.path.join(folder, 'index.json')
+            with open(CWR2_PATH, 'rb') as f:
+                e = EdiFile(f)
+                index = e.get_index(sidecar)
+                self.assertEqual(len(index), len(expected))
+                self.assertEqual(index.group_count, 1)
+                self.assertTrue(os.path.exists(sidecar))
+                for n in (0, 1, 57, len(expected) - 1):
+                    t = e.transaction_at(n)
+                    self.assertEqual(
+                        (str(t), t.valid, [r.to_edi() for r in t.records]),
+                        expected[n])
+                with self.assertRaises(IndexError):
+                    e.transaction_at(len(expected))
+                for i in range(2):
+                    group = e.group(1)
+                    transactions = list(group.get_transactions())
+                    self.assertEqual(len(transactions), len(expected))
+                    self.assertEqual(
+                        [str(err) for err in group.errors], group_errors)
+                with self.assertRaises(IndexError):
+                    e.group(2)
+            with open(CWR2_PATH, 'rb') as f:
+                e = EdiFile(f, bytes_mode=True)
+                for n in (0, 57):
+                    t = e.transaction_at(n)
+                    self.assertEqual(
+                        (str(t), t.valid, [r.to_edi() for r in t.records]),
+                        expected[n])
+                group = e.group(1)
+                self.assertIsInstance(group.header_line, bytes)
+                self.assertEqual(
+                    len(list(group.get_transactions())), len(expected))
+            with open(CWR2_PATH, 'rb') as f:
+                e = EdiFile(f)
+                self.assertEqual(
+                    e.get_index(sidecar).to_dict(), index.to_dict())
+
+            # stale sidecar, same size, one more transaction
+            path = os.path.join(folder, 'CW190001MPC_000.V21')
+            with open(CWR2_PATH, 'rb') as f:
+                data = f.read()
+            with open(path, 'wb') as f:
+                f.write(data)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(EdiFile(f).get_index(sidecar)), 100)
+            position = data.index(b'\nSPU', len(data) // 2) + 1
+            with open(path, 'r+b') as f:
+                f.seek(position)
+                f.write(b'NWR')
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            with open(path, 'rb') as f:
+                self.assertEqual(len(EdiFile(f).get_index(sidecar)), 101)
+            # unsupported version
+            with open(sidecar, 'w') as f:
+                json.dump({'version': 1}, f)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(EdiFile(f).get_index(sidecar)), 101)
+
+    def test_validate_structure(self):
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f)
+            errors = [str(err) for err in e.validate_structure()]
+            self.assertTrue(e.valid)
+            self.assertEqual(e.file_errors, [])
+            self.assertIn('Wrong transaction sequence 33, should be 2', errors)
+            self.assertIn(
+                'Wrong transaction sequence 000000X2, should be 2', errors)
+            expected = []
+            for group in e.get_groups():
+                for transaction in group.get_transactions():
+                    expected.extend(
+                        str(err) for err in transaction.errors
+                        if isinstance(err, FileError))
+                expected.extend(str(err) for err in group.errors)
+            expected.extend(str(err) for err in e.file_errors)
+            self.assertEqual(sorted(set(errors)), sorted(set(expected)))
+            file_errors = [str(err) for err in e.file_errors]
+
+        with open(CWR3_PATH, 'rb') as f:
+            data = f.read()
+        e = EdiFile(io.BytesIO(data))
+        self.assertEqual(
+            [str(err) for err in e.validate_structure()],
+            ['File trailer missing'])
+        e = EdiFile(io.BytesIO(data + b'TRL000010000001900000050\n'))
+        self.assertEqual(e.validate_structure(), [])
+
+        with open(__file__, 'rb') as f:
+            with self.assertRaises(FileError):
+                EdiFile(f).validate_structure()
+
+        # without EdiBytesReader, then full parsing
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f, use_mmap=False)
+            self.assertEqual(
+                sorted(set(str(err) for err in e.validate_structure())),
+                sorted(set(expected)))
+            self.assertEqual(
+                len([t for g in e.get_groups()
+                     for t in g.get_transactions()]), 100)
+            self.assertEqual(
+                [str(err) for err in e.file_errors], file_errors)
+        # also once parsing has started, it continues afterwards
+        for kwargs in ({}, {'use_mmap': False}):
+            with open(CWR2_PATH, 'rb') as f:
+                e = EdiFile(f, **kwargs)
+                group = next(e.get_groups())
+                transactions = group.get_transactions()
+                for i in range(10):
+                    next(transactions)
+                self.assertEqual(
+                    sorted(set(str(err) for err in e.validate_structure())),
+                    sorted(set(expected)))
+                self.assertEqual(len(list(transactions)), 90)
+        # pipes can not be read again
+        read_fd, write_fd = os.pipe()
+        with open(read_fd, 'rb') as f:
+            with open(write_fd, 'wb') as w:
+                w.write(data)
+            e = EdiFile(f)
+            self.assertIsNone(e._reader)
+            with self.assertRaises(RuntimeError):
+                e.validate_structure()
+
+    def test_writer(self):
+        with open(CWR3_PATH, 'rb') as f:
+            e = EdiFile(f)
+            output = io.BytesIO()
+            writer = EdiWriter(output, e.header(), buffer_size=1024)
+            for group in e.get_groups():
+                writer.write_group(
+                    group.type, group.get_transactions(), group.header())
+            writer.close()
+            writer.close()
+        with self.assertRaises(ValueError):
+            writer.write_record(e.header())
+        self.assertTrue(output.getvalue().endswith(
+            b'GRT000010000001900000048\r\nTRL000010000001900000050\r\n'))
+
+        output.seek(0)
+        e = EdiFile(output)
+        self.assertEqual(e.validate_structure(), [])
+        for group in e.get_groups():
+            self.assertEqual(group.sequence, 1)
+            for transaction in group.get_transactions():
+                self.assertTrue(transaction.valid)
+        self.assertTrue(e.valid)
+
+        output = io.BytesIO()
+        with EdiWriter(output, 'HDR', newline='\n') as writer:
+            with self.assertRaises(ValueError):
+                writer.write_transaction([])
+            with self.assertRaises(ValueError):
+                writer.end_group()
+            writer.start_group('WRK')
+            r = EdiTransactionRecord()
+            r.record_type = 'WRK'
+            writer.write_transaction([r])
+            writer.write_transaction([r])
+            writer.start_group('WRK')
+        self.assertEqual(output.getvalue().decode().split('\n'), [
+            'HDR', 'GRHWRK00001', 'WRK0000000000000000',
+            'WRK0000000100000000', 'GRT000010000000200000004',
+            'GRHWRK00002', 'GRT000020000000000000002',
+            'TRL000020000000200000008', ''])
+
+    def test_html(self):
+        record = EdiTransactionRecord('ABC00000000000000001<b>')
+        self.assertEqual(
+            record.to_html(),
+            '<span class="record abc"><span class="field edifield object '
+            'record_type" title ="record type: ABC">ABC</span><span '
+            'class="field edinumericfield edifield '
+            'transaction_sequence_number" title ="transaction sequence '
+            'number: 0">00000000</span><span class="field edinumericfield '
+            'edifield record_sequence_number" title ="record sequence '
+            'number: 0">00000000</span><span class="field nonetype object " '
+            'title =": 1&lt;b&gt;">1&lt;b&gt;</span></span>')
+
+        with open(CWR2_PATH, 'rb') as f:
+            lines = f.read().decode('latin1').splitlines()
+        with open(CWR2_PATH, 'rb') as f:
+            chunks = list(EdiFile(f).iter_html())
+        self.assertEqual(len(chunks), len(lines))
+        self.assertTrue(chunks[0].startswith('<span class="record hdr">'))
+        self.assertTrue(
+            chunks[-1].startswith('<span class="record trl invalid">'))
+        with open(CWR2_PATH, 'rb') as f:
+            for group in EdiFile(f).get_groups():
+                transaction = next(group.get_transactions())
+                self.assertEqual(
+                    transaction.to_html(),
+                    ''.join(r.to_html() + '\n' for r in transaction.records))
+                break
+
+    def test_columns(self):
+        with open(CWR2_PATH, 'rb') as f:
+            records = [
+                record for group in EdiFile(f).get_groups()
+                for transaction in group.get_transactions()
+                for record in transaction.records]
+        columns = to_columns(records)
+        self.assertEqual(sum(len(c) for c in columns.values()), len(records))
+        spt = columns['SPT']
+        self.assertEqual(list(spt.columns), list(EdiTransactionRecord._fields))
+        self.assertEqual(spt.columns['record_type'][0], 'SPT')
+        self.assertEqual(spt.columns['transaction_sequence_number'][0], 0)
+        self.assertEqual(spt.columns['record_sequence_number'][0], 22)
+        self.assertEqual(spt.columns['record_sequence_number'][1], 4)
+        self.assertFalse(spt.valid[0])
+        self.assertTrue(spt.valid[1])
+        # non-numeric value in a numeric field
+        self.assertIn(MISSING, spt.columns['record_sequence_number'])
+        if numpy is None:
+            with self.assertRaises(ImportError):
+                spt.to_numpy()
+        else:
+            a = spt.to_numpy()
+            self.assertEqual(a['record_type'][0], 'SPT')
+            self.assertEqual(a['record_sequence_number'][1], 4)
+            self.assertEqual(a['valid'].sum(), sum(spt.valid))
+
+    def test_batch_decoding(self):
+        with open(CWR2_PATH, 'rb') as f:
+            e = EdiFile(f)
+            lines = [
+                line for group in e.get_groups()
+                for transaction in group.get_transactions()
+                for line in transaction.lines]
+        transaction = EdiTransaction('NWR')
+        lines.append('SPT0000000000000001')  # too short
+        lines.append('SPT00000000000000011234567890')  # numeric errors
+        records = [
+            transaction.get_record_class(line[0:3])(line) for line in lines]
+
+        def summary(columns):
+            return dict(
+                (record_type, (
+                    [list(column) for column in c.columns.values()],
+                    list(c.valid),
+                    [(row, label, str(e)) for row, label, e in c.errors]))
+                for record_type, c in columns.items())
+
+        expected = summary(to_columns(records))
+        self.assertEqual(
+            summary(lines_to_columns(lines, transaction.get_record_class)),
+            expected)
+        # lines from byte-level parsing
+        byte_lines = [line.encode('latin1') for line in lines]
+        module_numpy = columns_module.numpy
+        columns_module.numpy = None
+        try:
+            self.assertEqual(summary(lines_to_columns(
+                lines, transaction.get_record_class)), expected)
+            self.assertEqual(summary(lines_to_columns(
+                byte_lines, transaction.get_record_class)), expected)
+        finally:
+            columns_module.numpy = module_numpy
+        self.assertEqual(summary(lines_to_columns(
+            byte_lines, transaction.get_record_class)), expected)
+        # positions are in characters
+        columns = lines_to_columns(
+            ['NWR0000000000000000CAFÉ      0123'.encode('utf-8')],
+            TitleTransaction('NWR').get_record_class, 'utf-8')
+        self.assertEqual(columns['NWR'].columns['title'], ['CAFÉ'])
+        self.assertEqual(list(columns['NWR'].columns['duration']), [123])
+
+    def test_dispatch(self):
+        # local file classes must not be found by other tests
+        self.addCleanup(gc.collect)
+        self.addCleanup(EdiFile._dispatch_cache.clear)
+
+        class CwrFile(EdiFile):
+            @classmethod
+            def is_my_header(cls, hdr):
+                return hdr.startswith('HDR')
+
+        class Cwr21File(CwrFile):
+            pass
+
+        class Cwr30File(CwrFile):
+            @classmethod
+            def is_my_header(cls, hdr):
+                return hdr.startswith('HDR') and '3.0000' in hdr
+
+        class IsrTransaction(EdiTransaction):
+            record_type = 'ISR'
+
+        class IsrGroup(EdiGroup):
+            transaction_classes = [EdiTransaction, IsrTransaction]
+
+        Cwr30File.group_class = IsrGroup
+
+        with open(CWR2_PATH, 'rb') as f:
+            self.assertIs(type(EdiFile(f)), CwrFile)
+        with open(CWR3_PATH, 'rb') as f:
+            e = EdiFile(f)
+            self.assertIs(type(e), Cwr30File)
+            for group in e.get_groups():
+                self.assertIs(group.get_transaction_class(), IsrTransaction)
+                for transaction in group.get_transactions():
+                    self.assertIsInstance(transaction, IsrTransaction)
+        self.assertIs(EdiGroup().get_transaction_class(), EdiTransaction)
+        self.assertEqual(
+            EdiFile.get_file_classes(), (Cwr30File, CwrFile))
+
+        # classes are not kept alive by dispatch
+        class CrdFile(EdiFile):
+            @classmethod
+            def is_my_header(cls, hdr):
+                return False
+
+        self.assertIn(CrdFile, EdiFile.get_file_classes())
+        crd_file = weakref.ref(CrdFile)
+        del CrdFile
+        EdiFile._dispatch_cache.clear()
+        gc.collect()
+        self.assertIsNone(crd_file())
+        self.assertEqual(
+            EdiFile.get_file_classes(), (Cwr30File, CwrFile))
+
+    def test_instrumentation(self):
+        readline = EdiFile.readline
+        with instrumentation.profiling() as stats:
+            self.assertIs(instrumentation.get_stats(), stats)
+            self.assertIsNot(EdiFile.readline, readline)
+            with open(CWR2_PATH, 'rb') as f:
+                for group in EdiFile(f).get_groups():
+                    for transaction in group.get_transactions():
+                        pass
+        self.assertIs(EdiFile.readline, readline)
+        self.assertIsNone(instrumentation.get_stats())
+
+        d = stats.as_dict()
+        # all lines, and the end of the file
+        self.assertEqual(d['stages']['read_line']['calls'], 1615)
+        self.assertEqual(d['stages']['get_transactions']['calls'], 101)
+        self.assertEqual(
+            d['record_types']['split_into_records']['NWR']['calls'], 100)
+        self.assertEqual(
+            d['record_types']['split_into_fields']['GRT']['calls'], 1)
+        self.assertGreater(
+            d['record_types']['error_handling']['SPT']['calls'], 0)
+        self.assertGreater(d['stages']['split_into_fields']['seconds'], 0)
+        text = stats.to_prometheus()
+        self.assertIn('# TYPE edi_stage_calls_total counter\n', text)
+        self.assertIn(
+            'edi_stage_calls_total{stage="split_into_records",'
+            'record_type="NWR"} 100\n', text)
+        stats.reset()
+        self.assertEqual(stats.as_dict(), {'stages': {}, 'record_types': {}})
+
+        # field errors are counted when reported and when read
+        with instrumentation.profiling() as stats:
+            record = EdiTransactionRecord('NWR00000000000000X1')
+            self.assertIn('record_sequence_number', record.errors)
+        d = stats.as_dict()
+        self.assertEqual(
+            d['record_types']['error_handling'],
+            {'NWR': {'calls': 2,
+                     'seconds': d['stages']['error_handling']['seconds']}})
+        # counted once per field, also through super(), the record type
+        # may be memoized already
+        self.assertIn(d['stages']['convert_field']['calls'], (2, 3))
+
     def transaction_0(self, transaction):
         self.assertEqual(str(transaction), 'NWR00000000')
         self.assertFalse(transaction.valid)
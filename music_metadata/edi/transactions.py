@@ -6,37 +6,74 @@ most notably Common Works Registration (CWR) and Common Royalty Distribution
 This file contains the transaction skeleton."""
 
 from .errors import FileError, RecordError
-from .records import EdiRecord, EdiTransactionRecord
+from .records import EdiRecord, EdiTransactionRecord, peek_number
 
 
 class EdiTransaction(object):
-    """Base class for all transactions."""
+    """Base class for all transactions.
+
+    In lazy mode, records are created in lazy mode, and validation is
+    postponed until valid or errors are read, or validate() is called.
+
+    Lines can also be bytes, then encoding is passed to records.
+
+    If record_types is set, only records of these types are created, other
+    lines are skipped, and only created records are validated. Sequence
+    numbers of skipped lines are still checked (validate_skipped_line), but
+    record order (validate_record_order) is not."""
 
     record_type = None
     record_classes = {}
 
-    def __init__(self, gtype, lines=None, sequence=None, *args, **kwargs):
+    def __init__(self, gtype, lines=None, sequence=None, *args, lazy=False,
+                 encoding=None, record_types=None, **kwargs):
         self.type = gtype
+        self._encoding = encoding
+        self.record_types = record_types
         self.sequence = sequence
-        self.valid = True
-        self.errors = []  # Transaction-level errors
+        self._valid = True
+        self._errors = []  # Transaction-level errors
+        self._lazy = lazy
+        self._pending = []  # Records with postponed validation
         if lines:
             self.lines = lines
             self.records = list(self.split_into_records())
-            self.validate_record_order()
+            if not lazy and record_types is None:
+                self.validate_record_order()
         else:
+            self._lazy = False
             self.lines = []
             self.records = []
 
+    @property
+    def valid(self):
+        if self._lazy:
+            self.validate()
+        return self._valid
+
+    @valid.setter
+    def valid(self, value):
+        self._valid = value
+
+    @property
+    def errors(self):
+        if self._lazy:
+            self.validate()
+        return self._errors
+
+    @errors.setter
+    def errors(self, value):
+        self._errors = value
+
     def __str__(self):
         return f'{self.type}{self.sequence:08d}'
 
     def error(self, error, record=None, fieldname=None):
         """Add an error, and invalidate."""
-        if record is not None and error not in record.errors:
+        if record is not None and error not in record.get_errors():
             record.error(fieldname, error)
-        self.errors.append(error)
-        self.valid = False
+        self._errors.append(error)
+        self._valid = False
 
     def validate_record_order(self):
         return
@@ -45,27 +82,86 @@ class EdiTransaction(object):
         return self.record_classes.get(record_type, EdiTransactionRecord)
 
     def split_into_records(self):
-        expected_t_sequence = self.sequence or 0
+        kwargs = {'lazy': True} if self._lazy else {}
+        encoding = self._encoding
+        if encoding:
+            kwargs['encoding'] = encoding
+        record_types = self.record_types
         for expected_r_sequence, line in enumerate(self.lines):
+            record_type = line[0:3]
+            if encoding:
+                record_type = record_type.decode('latin1')
+            if record_types is not None and record_type not in record_types:
+                self.validate_skipped_line(line, expected_r_sequence)
+                continue
             try:
-                Record = self.get_record_class(line[0:3])
-                record = Record(line, expected_r_sequence)
+                Record = self.get_record_class(record_type)
+                record = Record(line, expected_r_sequence, **kwargs)
             except (RecordError, FileError) as e:
-                record = EdiTransactionRecord(line, expected_r_sequence)
+                record = EdiTransactionRecord(
+                    line, expected_r_sequence, encoding=encoding)
                 record.error(None, e)
-                self.valid &= record.valid
+                self._valid &= record.valid
                 yield record
                 continue
 
-            record.validate_sequences(expected_t_sequence, expected_r_sequence)
-            record.validate()
-            self.valid &= record.valid
-            for error in record.errors.values():
-                if isinstance(error, FileError):
-                    self.error(error, record)
-                    break
+            if self._lazy:
+                self._pending.append((record, expected_r_sequence))
+            else:
+                self.validate_record(record, expected_r_sequence)
             yield record
 
+    def validate_record(self, record, expected_r_sequence):
+        """Validate a single record and collect its file-level errors."""
+        record.validate_sequences(self.sequence or 0, expected_r_sequence)
+        record.validate()
+        self._valid &= record.valid
+        for error in record.get_errors().values():
+            if isinstance(error, FileError):
+                self.error(error, record)
+                break
+
+    def validate_skipped_line(self, line, expected_r_sequence):
+        """Check sequence numbers of a line skipped by record types, as in
+        validate_record, but without creating the record."""
+        for label, expected in (
+                ('transaction_sequence_number', self.sequence or 0),
+                ('record_sequence_number', expected_r_sequence)):
+            value = peek_number(EdiTransactionRecord, line, label)
+            if isinstance(value, bytes):
+                value = value.decode('latin1')
+            if value != expected:
+                self.error(FileError(
+                    f'Wrong transaction sequence { value }, should be '
+                    f'{ expected }'))
+                break
+
+    def validate(self):
+        """Validate all records, this ends the lazy mode."""
+        if not self._lazy:
+            return
+        self._lazy = False
+        pending, self._pending = self._pending, []
+        for record, expected_r_sequence in pending:
+            self.validate_record(record, expected_r_sequence)
+        if self.record_types is None:
+            self.validate_record_order()
+
+    def release(self):
+        """Validate, then release records and lines, to free memory.
+        Validity and errors are kept."""
+        self.validate()
+        self.records = []
+        self.lines = []
+
+    def iter_html(self):
+        """Yield HTML representation of records, one line per record."""
+        for record in self.records:
+            yield record.to_html() + '\n'
+
+    def to_html(self):
+        return ''.join(self.iter_html())
+
     def to_dict(self, verbosity=1):
         return {
             'error': 'Not implemented for this file type.',
@@ -0,0 +1,140 @@
+"""
+Music Metadata - EDI is a base library for several EDI-based formats by CISAC,
+most notably Common Works Registration (CWR) and Common Royalty Distribution
+(CRD).
+
+This file contains the streaming writer."""
+
+from .file import EdiFile
+from .records import EdiTransactionRecord
+from .transactions import EdiTransaction
+
+
+class EdiWriter(object):
+    """Streaming writer for EDI files.
+
+    Records are written to a binary file object in buffered chunks, as
+    soon as they are passed. Group codes, transaction and record sequence
+    numbers are assigned, and group and file trailers with correct counts
+    are written automatically.
+
+    Record classes for group headers and trailers, and for the file
+    trailer, are taken from file_class."""
+
+    def __init__(self, fileobj, header, file_class=EdiFile,
+                 encoding='latin1', newline='\r\n', buffer_size=65536):
+        self.fileobj = fileobj
+        self.file_class = file_class
+        self.encoding = encoding
+        self.newline = newline
+        self.buffer_size = buffer_size
+        self._chunks = []
+        self._buffered = 0
+        self.group_count = 0
+        self.transaction_count = 0
+        self.record_count = 0
+        self.current_group = None
+        self.closed = False
+        self.write_record(header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.flush()
+
+    def write_record(self, record):
+        """Write a single record (or line) as it is, and count it."""
+        if self.closed:
+            raise ValueError('Writer is closed.')
+        line = (str(record) + self.newline).encode(self.encoding)
+        self._chunks.append(line)
+        self._buffered += len(line)
+        self.record_count += 1
+        if self.current_group is not None:
+            self.current_group['record_count'] += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered chunks to the file object."""
+        if self._chunks:
+            self.fileobj.write(b''.join(self._chunks))
+            self._chunks = []
+            self._buffered = 0
+
+    def start_group(self, transaction_type, header=None):
+        """Start a new group, ending the current one, if any.
+
+        If header (record) is not set, a minimal one is created."""
+        if self.current_group is not None:
+            self.end_group()
+        self.group_count += 1
+        if header is None:
+            header = self.file_class.group_class.header_class()
+            header.record_type = 'GRH'
+            header.transaction_type = transaction_type
+        header.group_code = self.group_count
+        self.current_group = {
+            'transaction_type': transaction_type,
+            'transaction_count': 0,
+            'record_count': 0}
+        self.write_record(header)
+
+    def write_transaction(self, transaction):
+        """Write a transaction (EdiTransaction or list of records).
+
+        Transaction and record sequence numbers are set."""
+        if self.current_group is None:
+            raise ValueError('No group started.')
+        if isinstance(transaction, EdiTransaction):
+            records = transaction.records
+        else:
+            records = transaction
+        sequence = self.current_group['transaction_count']
+        for record_sequence, record in enumerate(records):
+            if isinstance(record, EdiTransactionRecord):
+                record.transaction_sequence_number = sequence
+                record.record_sequence_number = record_sequence
+            self.write_record(record)
+        self.current_group['transaction_count'] += 1
+        self.transaction_count += 1
+
+    def end_group(self):
+        """Write the group trailer with counts."""
+        if self.current_group is None:
+            raise ValueError('No group started.')
+        trailer = self.file_class.group_class.trailer_class()
+        trailer.record_type = 'GRT'
+        trailer.group_code = self.group_count
+        trailer.transaction_count = self.current_group['transaction_count']
+        # header and trailer are included
+        trailer.record_count = self.current_group['record_count'] + 1
+        self.write_record(trailer)
+        self.current_group = None
+
+    def write_group(self, transaction_type, transactions, header=None):
+        """Write a whole group from an iterable of transactions."""
+        self.start_group(transaction_type, header)
+        for transaction in transactions:
+            self.write_transaction(transaction)
+        self.end_group()
+
+    def close(self):
+        """End the current group, write the file trailer and flush."""
+        if self.closed:
+            return
+        if self.current_group is not None:
+            self.end_group()
+        trailer = self.file_class.trailer_class()
+        trailer.record_type = 'TRL'
+        trailer.group_count = self.group_count
+        trailer.transaction_count = self.transaction_count
+        # file trailer is included
+        trailer.record_count = self.record_count + 1
+        self.write_record(trailer)
+        self.flush()
+        self.closed = True
@@ -17,6 +17,11 @@ setuptools.setup(
     package_data={
         '': ['CW19000*'],
     },
+    entry_points={
+        'console_scripts': [
+            'music-metadata-edi = music_metadata.edi.cli:main',
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.7",